@@ -0,0 +1,197 @@
+"""
+Benchmark the Host and Build hot paths against a fake host.
+
+Measures the number of round-trips, the bytes transferred and the wall time for each step of a typical session on
+synthetic feedstocks and logs, with Linux and Windows host personalities and an injected network latency. Windows hosts
+are measured both with the persistent PowerShell session and with separate cmd commands, which is the fallback when the
+session can't be started.
+
+Usage:
+    python benchmarks/bench.py --latency 50 --log-lines 5000
+"""
+import click
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+import types
+import zipfile
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakehost
+import sisyphus.host
+import sisyphus.util
+from sisyphus.build import Build, CBC_URL
+from sisyphus.host import Host, LINUX_TYPE, WINDOWS_TYPE
+from sisyphus.script import Script
+
+
+PACKAGE = "bench"
+
+
+def feedstock_zip(files, size):
+    """
+    Create a synthetic GitHub feedstock archive.
+    """
+    data = io.BytesIO()
+    top = f"{PACKAGE}-feedstock-main"
+    with zipfile.ZipFile(data, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(f"{top}/", "")
+        zf.writestr(f"{top}/recipe/", "")
+        zf.writestr(f"{top}/recipe/meta.yaml", f"package:\n  name: {PACKAGE}\n  version: 1.0\n")
+        for i in range(files):
+            zf.writestr(f"{top}/recipe/patches/{i:04d}.patch", os.urandom(size // 2).hex())
+    return data.getvalue()
+
+
+class Session:
+    """
+    Run the steps of a typical session against a fake host and record what each one costs.
+    """
+    def __init__(self, remote, feedstock, label):
+        self.remote = remote
+        self.feedstock = feedstock
+        self.label = label
+        self.results = []
+
+
+    def stream(self, url, f):
+        """
+        Replaces util.stream() to serve the synthetic data.
+        """
+        f.write(b"c_compiler:\n  - vs2019\n" if url == CBC_URL else self.feedstock)
+
+
+    def measure(self, name, step):
+        """
+        Run a step and record its cost.
+        """
+        self.remote.reset()
+        start = time.perf_counter()
+        result = step()
+        wall = time.perf_counter() - start
+        c = self.remote.reset()
+        self.results.append({
+            "personality": self.label,
+            "step": name,
+            "round_trips": c.round_trips,
+            "commands": c.commands,
+            "transfers": c.transfers,
+            "bytes_up": c.bytes_up,
+            "bytes_down": c.bytes_down,
+            "wall": wall,
+        })
+        return result
+
+
+    def upload(self, h):
+        """
+        Upload the data and unpack it the same way the build command does.
+        """
+        b = Build(PACKAGE, "main")
+        b.upload_data(h)
+        workdir = h.path(PACKAGE)
+        tarfile = h.path(b.tarfile)
+        s = Script(h)
+        s.rm(workdir)
+        s.untar(tarfile, workdir)
+        s.rm(tarfile)
+        s.execute()
+
+
+    def resume(self, h):
+        """
+        Lose the connection, then follow the log of a copy of the build like the watch command does. On Windows the
+        PowerShell session fails first, Host falls back to cmd to reconnect and starts a new session afterwards.
+        """
+        workdir = h.path(PACKAGE + "-resume")
+        shutil.copytree(self.remote.local(h.path(PACKAGE)), self.remote.local(workdir))
+        self.remote.drop()
+        if h.exists(workdir):
+            h.watch_build(workdir)
+
+
+    def run(self, destination):
+        no_sleep = types.SimpleNamespace(sleep=lambda s: None, time=time.time, perf_counter=time.perf_counter)
+        cwd = os.getcwd()
+        with mock.patch.object(sisyphus.host, "fabric", types.SimpleNamespace(Connection=self.remote.connection)), \
+             mock.patch.object(sisyphus.host, "time", no_sleep), \
+             mock.patch.object(sisyphus.util, "stream", self.stream):
+            try:
+                h = self.measure("connect", lambda: Host("fake"))
+                self.measure("prepare", lambda: (h.prepare(), h.watch_prepare()))
+                self.measure("upload", lambda: self.upload(h))
+                self.measure("build start", lambda: h.build(h.path(PACKAGE)))
+                self.measure("log follow", lambda: h.watch_build(h.path(PACKAGE)))
+                self.measure("log resume", lambda: self.resume(h))
+                self.measure("transmute", lambda: h.transmute(PACKAGE))
+                self.measure("download", lambda: h.download(PACKAGE, destination))
+            finally:
+                os.chdir(cwd)
+
+            # Local CPU cost of building paths, no round-trip involved
+            args = (h.sisyphus_dir, PACKAGE, "build", h.pkgdir, f"{PACKAGE}-1.0-0.tar.bz2")
+            n = 10000
+            seconds = timeit.timeit(lambda: h.path_join(*args), number=n)
+            self.results.append({"personality": self.label, "step": "path_join (µs/call)",
+                                 "round_trips": 0, "commands": 0, "transfers": 0, "bytes_up": 0, "bytes_down": 0,
+                                 "wall": seconds / n * 1e6})
+        return self.results
+
+
+def report(results):
+    """
+    Print the results as a table.
+    """
+    header = f"{'personality':<12}{'step':<22}{'trips':>7}{'cmds':>7}{'xfers':>7}{'KiB up':>10}{'KiB down':>10}{'wall':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['personality']:<12}{r['step']:<22}{r['round_trips']:>7}{r['commands']:>7}{r['transfers']:>7}"
+              f"{r['bytes_up'] / 1024:>10.1f}{r['bytes_down'] / 1024:>10.1f}{r['wall']:>10.3f}")
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("-p", "--personality", type=click.Choice([LINUX_TYPE, WINDOWS_TYPE]), multiple=True,
+              help="Host type to emulate, can be repeated. [default: both]")
+@click.option("--latency", type=float, default=50, show_default=True, help="Injected round-trip time in milliseconds.")
+@click.option("--bandwidth", type=float, help="Injected bandwidth in MiB/s. [default: unlimited]")
+@click.option("--log-lines", type=int, default=5000, show_default=True, help="Number of lines in the build log.")
+@click.option("--feedstock-files", type=int, default=50, show_default=True, help="Number of files in the feedstock.")
+@click.option("--file-size", type=int, default=4096, show_default=True, help="Size of the feedstock files in bytes.")
+@click.option("--package-size", type=int, default=8, show_default=True, help="Size of the built packages in MiB.")
+@click.option("--json", "as_json", is_flag=True, help="Output the results as JSON.")
+def main(personality, latency, bandwidth, log_lines, feedstock_files, file_size, package_size, as_json):
+    """
+    Benchmark the Host and Build hot paths against a fake host.
+    """
+    logging.basicConfig(level=logging.WARNING)
+    feedstock = feedstock_zip(feedstock_files, file_size)
+    results = []
+    variants = []
+    for p in personality or (LINUX_TYPE, WINDOWS_TYPE):
+        variants.append((p, p, True))
+        if p == WINDOWS_TYPE:
+            variants.append((p, f"{p}-cmd", False))
+    for p, label, powershell in variants:
+        with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as destination:
+            remote = fakehost.Remote(root, personality=p, latency=latency / 1000,
+                                     bandwidth=bandwidth * 1024 * 1024 if bandwidth else None,
+                                     log_lines=log_lines, package_size=package_size * 1024 * 1024,
+                                     powershell=powershell)
+            results += Session(remote, feedstock, label).run(destination)
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
+
+
+if __name__ == "__main__":
+    main()
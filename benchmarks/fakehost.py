@@ -0,0 +1,735 @@
+"""
+In-process fake of the fabric connection used by Host, for benchmarking without a real build host.
+
+The fake interprets the commands Host sends, for both Linux and Windows syntax, as well as the scripts sent to the
+persistent PowerShell session on Windows, against a local directory standing in for the remote file system. Every
+round-trip and transfer is counted and can be slowed down with an injected latency and bandwidth. Connections can be
+dropped to exercise reconnecting.
+"""
+import io
+import os
+import re
+import shlex
+import shutil
+import tarfile
+import threading
+import time
+import types
+
+from sisyphus import powershell
+from sisyphus.host import LINUX_TYPE, WINDOWS_TYPE
+from sisyphus.script import MARKER
+
+
+# Keep a reference to the real sleep, the benchmarks disable the one used by Host for its polling loops
+_sleep = time.sleep
+
+
+class CommandError(Exception):
+    """
+    A fake remote command failed, stands in for fabric's UnexpectedExit.
+    """
+    def __init__(self, cmd, return_code, stderr):
+        super().__init__(f"'{cmd}' exited with status {return_code}: {stderr}")
+        self.return_code = return_code
+        self.result = Result("", stderr, return_code)
+
+
+class Result:
+    """
+    Result of a fake remote command, with the attributes of fabric's.
+    """
+    def __init__(self, stdout, stderr="", return_code=0):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.return_code = return_code
+
+
+class Counters:
+    """
+    What a scenario cost in terms of network activity.
+    """
+    def __init__(self):
+        self.commands = 0
+        self.transfers = 0
+        self.pings = 0
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+
+    @property
+    def round_trips(self):
+        return self.commands + self.transfers + self.pings
+
+
+class Remote:
+    """
+    State of the fake remote host, shared by all the connections to it.
+    """
+    def __init__(self, root, personality=LINUX_TYPE, latency=0, bandwidth=None, log_lines=1000, package_size=1024 * 1024,
+                 powershell=True):
+        """
+        root: local directory standing in for the remote file system
+        personality: host type to emulate
+        powershell: whether Windows hosts can run a persistent PowerShell session
+        latency: round-trip time in seconds
+        bandwidth: bytes per second, unlimited if None
+        log_lines: number of lines in the logs of fake builds
+        package_size: size in bytes of the packages created by fake builds
+        """
+        self.root = root
+        self.personality = personality
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.log_lines = log_lines
+        self.package_size = package_size
+        self.powershell = powershell
+        self.counters = Counters()
+        self.lock = threading.Lock()
+        self.connections = []
+        # Round-trips left before the connections drop, never if None
+        self.drop_after = None
+
+
+    def drop(self, after=0):
+        """
+        Kill all the current connections after some more round-trips, like a VPN going down would.
+        """
+        with self.lock:
+            self.drop_after = after
+        if after == 0:
+            self.__drop()
+
+
+    def __drop(self):
+        self.drop_after = None
+        for connection in self.connections:
+            connection.alive = False
+        self.connections = []
+
+
+    def reset(self):
+        """
+        Reset the counters and return the previous ones.
+        """
+        with self.lock:
+            counters = self.counters
+            self.counters = Counters()
+        return counters
+
+
+    def cost(self, bytes_up=0, bytes_down=0, command=True):
+        """
+        Account for a round-trip and simulate its duration.
+        """
+        with self.lock:
+            if command:
+                self.counters.commands += 1
+            else:
+                self.counters.transfers += 1
+            self.counters.bytes_up += bytes_up
+            self.counters.bytes_down += bytes_down
+            if self.drop_after is not None:
+                self.drop_after -= 1
+                if self.drop_after <= 0:
+                    self.__drop()
+        delay = self.latency
+        if self.bandwidth:
+            delay += (bytes_up + bytes_down) / self.bandwidth
+        if delay:
+            _sleep(delay)
+
+
+    def local(self, path, cwd=None):
+        """
+        Translate a remote path into a local one.
+        """
+        path = path.strip('"').replace("\\", "/")
+        path = re.sub("^[A-Za-z]:", "", path)
+        if not path.startswith("/"):
+            path = (cwd or "/") + "/" + path
+        return os.path.normpath(os.path.join(self.root, path.lstrip("/")))
+
+
+    def connection(self, user=None, connect_timeout=None, host=None, **kwargs):
+        """
+        Create a connection, replaces fabric.Connection.
+        """
+        connection = Connection(self)
+        with self.lock:
+            self.connections.append(connection)
+        return connection
+
+
+class Connection:
+    """
+    Fake fabric connection.
+    """
+    def __init__(self, remote):
+        self.remote = remote
+        self.alive = True
+        transport = Transport(remote, self)
+        self.client = types.SimpleNamespace(get_transport=lambda: transport)
+
+
+    def check(self):
+        """
+        Fail like paramiko does when using a dead connection.
+        """
+        if not self.alive:
+            raise OSError("Socket is closed")
+
+
+    def open(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+    def run(self, cmd, hide=None, asynchronous=False, warn=False):
+        """
+        Run a command, background commands complete before returning which is fine for benchmarking.
+        """
+        self.check()
+        out = io.StringIO()
+        try:
+            code = Shell(self.remote, out).run(cmd)
+        finally:
+            self.remote.cost(bytes_up=len(cmd), bytes_down=len(out.getvalue()))
+        if code != 0 and not warn and not asynchronous:
+            raise CommandError(cmd, code, out.getvalue())
+        return Result(out.getvalue(), return_code=code)
+
+
+    def put(self, source, dest):
+        """
+        Upload a local file to a remote file or directory.
+        """
+        self.check()
+        target = self.remote.local(dest)
+        if os.path.isdir(target):
+            target = os.path.join(target, os.path.basename(source))
+        shutil.copyfile(source, target)
+        self.remote.cost(bytes_up=os.path.getsize(source), command=False)
+
+
+    def get(self, remote, local=None):
+        """
+        Download a remote file, to the current directory by default like fabric does.
+        """
+        self.check()
+        source = self.remote.local(remote)
+        if local is None or os.path.isdir(local):
+            local = os.path.join(local or os.getcwd(), os.path.basename(source))
+        shutil.copyfile(source, local)
+        self.remote.cost(bytes_down=os.path.getsize(source), command=False)
+        return types.SimpleNamespace(local=local, remote=remote)
+
+
+    def sftp(self):
+        self.check()
+        return SFTP(self.remote)
+
+
+class Transport:
+    """
+    Fake paramiko transport, answers the pings used to measure the link and opens the channel of the PowerShell session.
+    """
+    def __init__(self, remote, connection):
+        self.remote = remote
+        self.connection = connection
+        self.default_window_size = 2 * 1024 * 1024
+
+
+    def is_active(self):
+        return self.connection.alive
+
+
+    def global_request(self, kind, data=None, wait=True):
+        self.connection.check()
+        with self.remote.lock:
+            self.remote.counters.pings += 1
+        if self.remote.latency:
+            _sleep(self.remote.latency)
+
+
+    def set_keepalive(self, interval):
+        pass
+
+
+    def open_session(self):
+        self.connection.check()
+        return Channel(self.remote, self.connection)
+
+
+def template(build, *kinds):
+    """
+    Regex matching the PowerShell scripts made by a function of sisyphus.powershell, kinds tells whether each of its
+    arguments is a "path" or an "int". The arguments are captured in order, paths unquoted.
+    """
+    placeholders = [f"\x00{i}\x00" for i in range(len(kinds))]
+    pattern = re.escape(build(*placeholders))
+    for i, (placeholder, kind) in enumerate(zip(placeholders, kinds)):
+        group = r"\d+" if kind == "int" else r"(?:[^']|'')*"
+        # Paths are quoted several times, the later ones must be the same
+        pattern = pattern.replace(placeholder, f"(?P<a{i}>{group})", 1).replace(placeholder, f"(?P=a{i})")
+    regex = re.compile(pattern + "$")
+
+    def match(script):
+        m = regex.match(script)
+        if m is None:
+            return None
+        return [int(m.group(f"a{i}")) if kind == "int" else m.group(f"a{i}").replace("''", "'")
+                for i, kind in enumerate(kinds)]
+    return match
+
+
+class Channel:
+    """
+    Fake SSH channel running the persistent PowerShell session, interprets the scripts of sisyphus.powershell framed the
+    way PowerShell.run() frames them. Each request is a round-trip.
+    """
+    REQUEST = re.compile(rf"^Write-Output '{MARKER}-begin (\d+)'; \$ok = 1; try \{{ \$ErrorActionPreference = 'Stop'; "
+                         rf"(.*) \}} catch \{{ Write-Output \$_\.ToString\(\); \$ok = 0 \}}; "
+                         rf"Write-Output \"{MARKER}-end \1 \$ok\"$")
+    SCRIPTS = {
+        "exists": template(powershell.exists_script, "path"),
+        "isdir": template(powershell.isdir_script, "path"),
+        "ls": template(powershell.ls_script, "path"),
+        "mkdir": template(powershell.mkdir_script, "path"),
+        "rm": template(powershell.rm_script, "path"),
+        "follow": template(powershell.follow_script, "path", "int", "path", "path", "int"),
+    }
+
+    def __init__(self, remote, connection):
+        self.remote = remote
+        self.connection = connection
+        self.output = b""
+        self.exit_status = None
+        # Logs being followed, path -> [file, text read but not printed yet]
+        self.readers = {}
+
+
+    def exec_command(self, cmd):
+        if cmd != powershell.COMMAND or self.remote.personality != WINDOWS_TYPE or not self.remote.powershell:
+            # Like cmd saying the command isn't recognized
+            self.exit_status = 1
+
+
+    def settimeout(self, timeout):
+        pass
+
+
+    def sendall(self, data):
+        self.connection.check()
+        for line in data.decode().splitlines():
+            m = self.REQUEST.match(line)
+            if self.exit_status is not None or m is None:
+                continue
+            try:
+                output, ok = self.script(m.group(2)), 1
+            except Exception as e:
+                output, ok = str(e), 0
+            lines = [f"{MARKER}-begin {m.group(1)}"] + ([output] if output else []) + [f"{MARKER}-end {m.group(1)} {ok}"]
+            response = "".join(l + "\r\n" for l in lines).encode()
+            self.remote.cost(bytes_up=len(line), bytes_down=len(response))
+            self.output += response
+
+
+    def recv(self, size):
+        if not self.connection.alive:
+            return b""
+        data, self.output = self.output[:size], self.output[size:]
+        return data
+
+
+    def recv_exit_status(self):
+        return self.exit_status if self.exit_status is not None else -1
+
+
+    def close(self):
+        for f, _ in self.readers.values():
+            f.close()
+        self.readers = {}
+
+
+    def script(self, script):
+        """
+        Run a script and return its output.
+        """
+        local = self.remote.local
+        if script.startswith("[Console]::OutputEncoding"):
+            return ""
+        for name, match in self.SCRIPTS.items():
+            args = match(script)
+            if args is not None:
+                break
+        else:
+            raise ValueError(f"Unexpected PowerShell script: {script}")
+        path = local(args[0])
+        if name == "exists":
+            return "Yes" if os.path.exists(path) else "No"
+        elif name == "isdir":
+            return "Yes" if os.path.isdir(path) else "No"
+        elif name == "ls":
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Cannot find path '{args[0]}' because it does not exist.")
+            return "\r\n".join(sorted(os.listdir(path)))
+        elif name == "mkdir":
+            if os.path.isfile(path):
+                raise FileExistsError(f"{args[0]} already exists and is a file, can't create directory")
+            os.makedirs(path, exist_ok=True)
+        elif name == "rm":
+            # Windows doesn't delete files that are open
+            for logfile in self.readers:
+                if os.path.commonpath([path, local(logfile)]) == path:
+                    raise PermissionError(f"The process cannot access the file '{logfile}' because it is being used by "
+                                          "another process.")
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        elif name == "follow":
+            return self.follow(*args)
+        return ""
+
+
+    def follow(self, logfile, skip, ready, failed, max_lines):
+        """
+        Same as the script made by follow_script().
+        """
+        ready = os.path.exists(self.remote.local(ready))
+        failed = os.path.exists(self.remote.local(failed))
+        lines = []
+        if logfile not in self.readers and os.path.exists(self.remote.local(logfile)):
+            f = open(self.remote.local(logfile), newline="")
+            for _ in range(skip):
+                f.readline()
+            self.readers[logfile] = [f, ""]
+        if logfile in self.readers:
+            state = self.readers[logfile]
+            while state[1].count("\n") < max_lines and (data := state[0].read(65536)):
+                state[1] += data
+            parts = re.split(r"\r?\n", state[1])
+            count = min(len(parts) - 1, max_lines)
+            lines = parts[:count]
+            state[1] = "\n".join(parts[count:])
+            if "\n" in state[1]:
+                ready = failed = False
+            elif (ready or failed) and state[1]:
+                lines.append(state[1])
+                state[1] = ""
+            if ready or failed:
+                state[0].close()
+                del self.readers[logfile]
+        return "\r\n".join([f"{ready} {failed}"] + lines)
+
+
+class SFTP:
+    """
+    Fake paramiko SFTP client.
+    """
+    def __init__(self, remote):
+        self.remote = remote
+
+
+    def open(self, path, mode="r"):
+        self.remote.cost(command=False)
+        return File(self.remote, open(self.remote.local(path), mode if "b" in mode else mode + "b"))
+
+
+    def stat(self, path):
+        self.remote.cost(command=False)
+        return os.stat(self.remote.local(path))
+
+
+class File(io.RawIOBase):
+    """
+    Remote file opened through the fake SFTP client, transfers are accounted for when it's closed.
+    """
+    def __init__(self, remote, f):
+        self.remote = remote
+        self.f = f
+        self.up = 0
+        self.down = 0
+
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+
+    def prefetch(self, file_size=None):
+        pass
+
+
+    def readable(self):
+        return self.f.readable()
+
+
+    def writable(self):
+        return self.f.writable()
+
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.down += n
+        return n
+
+
+    def write(self, b):
+        n = self.f.write(b)
+        self.up += n
+        return n
+
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.f.seek(offset, whence)
+
+
+    def tell(self):
+        return self.f.tell()
+
+
+    def close(self):
+        if not self.closed:
+            self.f.close()
+            # Data is streamed so only the bandwidth matters, not the latency
+            if self.remote.bandwidth:
+                _sleep((self.up + self.down) / self.remote.bandwidth)
+            with self.remote.lock:
+                self.remote.counters.bytes_up += self.up
+                self.remote.counters.bytes_down += self.down
+        super().close()
+
+
+class Shell:
+    """
+    Interpreter for the commands Host sends, in either Linux or Windows syntax.
+    """
+    def __init__(self, remote, out):
+        self.remote = remote
+        self.out = out
+        self.cwd = None
+        self.windows = remote.personality == WINDOWS_TYPE
+
+
+    def run(self, cmd):
+        """
+        Run a whole command line and return its exit code.
+        """
+        cmd = cmd.strip()
+        if MARKER in cmd:
+            return self.script(cmd)
+        # Host type probes
+        if cmd == "uname -a":
+            return self.probe(not self.windows, "Linux fake 6.0.0 x86_64 GNU/Linux")
+        if cmd == "ver":
+            return self.probe(self.windows, "Microsoft Windows [Version 10.0.20348.0]")
+        # Steps with their errors discarded
+        m = re.match(r"\( (.*) \) 2>(/dev/null|nul)$", cmd)
+        if m:
+            return self.run(m.group(1))
+        m = re.match(r'if \[ -e "(.*?)" \]; then (.*); fi$', cmd)
+        if not self.windows and m:
+            return self.run(m.group(2)) if os.path.exists(self.remote.local(m.group(1))) else 0
+        m = re.match(r'if not exist "(.*?)\\\*" (.*)$', cmd)
+        if self.windows and m:
+            return 0 if os.path.isdir(self.remote.local(m.group(1))) else self.run(m.group(2))
+        if self.windows and cmd.startswith("if exist"):
+            return self.windows_if(cmd)
+        if not self.windows and cmd.startswith("if [["):
+            return self.linux_if(cmd)
+
+        # Chains of commands with && and ||
+        code = 0
+        for op, part in self.chain(cmd):
+            if (op == "&&" and code != 0) or (op == "||" and code == 0):
+                continue
+            code = self.simple(part)
+        return code
+
+
+    def script(self, cmd):
+        """
+        Run a script made by Host.script_cmd().
+        """
+        if self.windows:
+            steps = re.findall(rf"\(\((.*?)\) 2>&1 & if errorlevel 1 \(echo\. & echo {MARKER} (\d+) 1( & exit /b 0)?\)", cmd)
+        else:
+            steps = re.findall(rf"^\( (.*) \) 2>&1; rc=\$\?; printf '\\n{MARKER} (\d+) %d\\n' \$rc(; \[ \$rc -eq 0 \] \|\| exit 0)?$",
+                               cmd, re.MULTILINE)
+        for step, i, stop in steps:
+            code = Shell(self.remote, self.out).run(step)
+            if self.windows:
+                code = int(code != 0)
+            self.out.write(f"\n{MARKER} {i} {code}\n")
+            if code != 0 and stop:
+                break
+        return 0
+
+
+    def chain(self, cmd):
+        """
+        Split a command line on && and ||.
+        """
+        parts = re.split(r"\s+(&&|\|\|)\s+", cmd)
+        yield None, parts[0]
+        for i in range(1, len(parts), 2):
+            yield parts[i], parts[i + 1]
+
+
+    def probe(self, ok, output):
+        if not ok:
+            self.out.write("command not found")
+            return 1
+        self.out.write(output)
+        return 0
+
+
+    def linux_if(self, cmd):
+        m = re.match(r"if \[\[ -(e|d) '(.*)' \]\]; then echo Yes; fi$", cmd)
+        return self.test(m.group(1), m.group(2))
+
+
+    def windows_if(self, cmd):
+        m = re.match(r'if exist "(.*?)" (powershell .*)$', cmd)
+        if m:
+            return self.run(m.group(2)) if os.path.exists(self.remote.local(m.group(1))) else 0
+        m = re.match(r'if exist "(.*?)(\\\*)?" echo Yes$', cmd)
+        if m:
+            return self.test("d" if m.group(2) else "e", m.group(1))
+        # Deleting something without knowing if it's a file or a directory
+        m = re.match(r'if exist "(.*?)\\\*" \((.*)\) else \(if exist "(.*?)" (.*)\)$', cmd)
+        local = self.remote.local(m.group(1))
+        if os.path.isdir(local):
+            return self.run(m.group(2))
+        elif os.path.exists(local):
+            return self.run(m.group(4))
+        return 0
+
+
+    def test(self, kind, path):
+        local = self.remote.local(path)
+        if (kind == "e" and os.path.exists(local)) or (kind == "d" and os.path.isdir(local)):
+            self.out.write("Yes\n")
+        return 0
+
+
+    def split(self, cmd):
+        """
+        Tokenize a simple command, Windows doesn't have the same quoting rules.
+        """
+        if self.windows:
+            return [t.strip('"') for t in shlex.split(cmd, posix=False)]
+        return shlex.split(cmd)
+
+
+    def simple(self, cmd):
+        """
+        Run a simple command, possibly with redirections.
+        """
+        cmd = cmd.strip().rstrip(")").strip()
+        m = re.match(r"(tail -n \+(\d+) \"(.*)\" \| head -n (\d+))$", cmd)
+        if m:
+            return self.tail(m.group(3), int(m.group(2)) - 1, int(m.group(4)))
+        m = re.match(r'powershell -Command "Get-Content (.*) \| Select-Object -Skip (\d+) -First (\d+)"$', cmd)
+        if m:
+            return self.tail(m.group(1), int(m.group(2)), int(m.group(3)))
+
+        # Redirections
+        redirect = None
+        m = re.match(r"(.*?)\s+>\s+(\S+)(\s+2>&1)?$", cmd)
+        if m:
+            cmd, redirect = m.group(1), m.group(2)
+        cmd = re.sub(r"\s+2>(/dev/null|nul)$", "", cmd)
+        out = self.out
+        if redirect:
+            self.out = io.StringIO()
+        try:
+            code = self.dispatch(self.split(cmd))
+        finally:
+            if redirect:
+                with open(self.remote.local(redirect, self.cwd), "w") as f:
+                    f.write(self.out.getvalue())
+                self.out = out
+        return code
+
+
+    def dispatch(self, args):
+        name = args[0]
+        local = lambda p: self.remote.local(p, self.cwd)
+        if name == "cd":
+            self.cwd = args[1].replace("\\", "/")
+        elif name == "mkdir":
+            os.makedirs(local(args[-1]), exist_ok=True)
+        elif name in ("ls", "dir"):
+            if not os.path.isdir(local(args[-1])):
+                self.out.write("File Not Found")
+                return 2
+            self.out.write("\n".join(sorted(os.listdir(local(args[-1])))) + "\n")
+        elif name == "rm" or name == "rd":
+            shutil.rmtree(local(args[-1]), ignore_errors=True)
+        elif name == "del":
+            os.remove(local(args[-1]))
+        elif name == "touch" or (name == "copy" and args[1] == "nul"):
+            open(local(args[-1]), "a").close()
+        elif name in ("cat", "type"):
+            with open(local(args[1])) as f:
+                self.out.write(f.read())
+        elif name == "echo":
+            self.out.write(" ".join(args[1:]) + "\n")
+        elif name == "tar":
+            return self.tar(args)
+        elif name == "conda" or name.endswith("conda.exe"):
+            return self.conda(args)
+        elif name == "cph":
+            src = local(args[2])
+            ext = args[3]
+            dest = re.sub(r"\.(tar\.bz2|conda)$", ext, src)
+            shutil.copyfile(src, dest)
+        elif name in ("powershell", "anaconda", "true"):
+            # CUDA installation scripts and uploads to anaconda.org
+            pass
+        else:
+            self.out.write(f"{name}: command not found")
+            return 127
+        return 0
+
+
+    def tail(self, logfile, skip, max_lines):
+        with open(self.remote.local(logfile)) as f:
+            lines = f.readlines()[skip:skip + max_lines]
+        self.out.write("".join(lines))
+        return 0
+
+
+    def tar(self, args):
+        local = lambda p: self.remote.local(p, self.cwd)
+        if args[1] == "-x":
+            with tarfile.open(local(args[3])) as tf:
+                tf.extractall(local(args[5]), filter="data")
+        else:
+            with tarfile.open(local(args[2]), "w") as tf:
+                for name in args[3:]:
+                    tf.add(local(name), arcname=name.replace("\\", "/"))
+        return 0
+
+
+    def conda(self, args):
+        """
+        Emulate the conda commands, builds instantly produce a log and packages.
+        """
+        if args[1] == "env":
+            self.out.write("base      /opt/conda\nsisyphus  /opt/conda/envs/sisyphus\n")
+        elif args[1] == "build":
+            croot = self.remote.local([a for a in args if a.startswith("--croot=")][0].split("=", 1)[1])
+            pkgdir = os.path.join(croot, "win-64" if self.windows else "linux-64")
+            os.makedirs(pkgdir, exist_ok=True)
+            name = os.path.basename(os.path.dirname(croot))
+            with open(os.path.join(pkgdir, f"{name}-1.0-0.tar.bz2"), "wb") as f:
+                f.write(os.urandom(self.remote.package_size))
+            for i in range(self.remote.log_lines):
+                self.out.write(f"[{i:06d}] fake build output for {name}, nothing to see here\n")
+        return 0
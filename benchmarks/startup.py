@@ -0,0 +1,93 @@
+"""
+Measure the startup time of the CLI and check that it doesn't load more than it needs.
+
+Each case runs in a fresh interpreter, several times, keeping the fastest run. The help of every command must stay under
+the time budget and not load the network stack, and the commands working on hosts must not load the rocket-platform
+client, which only start-host and stop-host need.
+
+Usage:
+    python benchmarks/startup.py --budget 150
+"""
+import click
+import json
+import subprocess
+import sys
+import time
+
+from sisyphus.main import cli
+
+
+# Modules that mustn't be loaded just to show the help
+NETWORK = ("fabric", "invoke", "paramiko", "cryptography", "nacl", "bcrypt", "pushbutan", "githubkit")
+# Modules that mustn't be loaded by the commands that don't create or stop hosts
+ROCKET = ("pushbutan", "githubkit")
+# Modules used by the commands working on hosts
+HOST_MODULES = ("sisyphus.host", "sisyphus.build", "sisyphus.script", "sisyphus.journal", "sisyphus.channel",
+                "sisyphus.pipeline", "sisyphus.top", "sisyphus.aio")
+
+# Report the modules loaded when the interpreter exits, which is after click exits after showing the help
+CHILD = """
+import atexit, json, sys
+atexit.register(lambda: print(json.dumps(sorted(sys.modules)), file=sys.stderr))
+{code}
+"""
+
+
+def measure(code, runs):
+    """
+    Run some code in fresh interpreters, return the fastest wall time and the modules that were loaded.
+    """
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        p = subprocess.run([sys.executable, "-c", CHILD.format(code=code)], capture_output=True, text=True)
+        wall = time.perf_counter() - start
+        best = wall if best is None else min(best, wall)
+    modules = json.loads(p.stderr.strip().splitlines()[-1])
+    return best, modules
+
+
+@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+@click.option("--budget", type=float, default=150, show_default=True, help="Maximum startup time for help in milliseconds.")
+@click.option("--runs", type=int, default=5, show_default=True, help="Number of runs per case, the fastest is kept.")
+@click.option("--json", "as_json", is_flag=True, help="Output the results as JSON.")
+def main(budget, runs, as_json):
+    """
+    Measure the startup time of the CLI and check which modules it loads.
+    """
+    # Help for the whole CLI and for each command, then what the commands working on hosts load
+    cases = [("--help", "from sisyphus.main import cli; cli(['--help'])", NETWORK, budget)]
+    for name in sorted(cli.commands):
+        cases.append((f"{name} --help", f"from sisyphus.main import cli; cli([{name!r}, '--help'])", NETWORK, budget))
+    cases.append(("host commands", "import sisyphus.main, " + ", ".join(HOST_MODULES), ROCKET, None))
+
+    baseline, _ = measure("pass", runs)
+    results = []
+    for name, code, forbidden, limit in cases:
+        wall, modules = measure(code, runs)
+        loaded = sorted({m.split(".")[0] for m in modules} & set(forbidden))
+        results.append({
+            "case": name,
+            "wall": wall * 1000,
+            "over_interpreter": (wall - baseline) * 1000,
+            "modules": len(modules),
+            "forbidden": loaded,
+            "ok": not loaded and (limit is None or wall * 1000 <= limit),
+        })
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"Interpreter alone: {baseline * 1000:.1f}ms, budget for help: {budget:.0f}ms")
+        header = f"{'case':<22}{'wall ms':>10}{'+python':>10}{'modules':>9}  result"
+        print(header)
+        print("-" * len(header))
+        for r in results:
+            result = "ok" if r["ok"] else "FAIL " + " ".join(r["forbidden"])
+            print(f"{r['case']:<22}{r['wall']:>10.1f}{r['over_interpreter']:>10.1f}{r['modules']:>9}  {result}")
+    if not all(r["ok"] for r in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
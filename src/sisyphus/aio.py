@@ -0,0 +1,395 @@
+import asyncio
+import contextlib
+import fabric
+import logging
+import os
+
+from . import metrics
+from .host import Platform, LINUX_TYPE, WINDOWS_TYPE, LINUX_USER, WINDOWS_USER
+from .transport import Link
+
+
+class HostError(Exception):
+    """
+    Base class for all the errors raised by the asynchronous API.
+    """
+
+
+class ConnectionFailed(HostError):
+    """
+    The host can't be reached, its type can't be figured out, or the connection broke while talking to it.
+    """
+
+
+class CommandFailed(HostError):
+    """
+    A remote command exited with a non-zero status.
+    """
+    def __init__(self, cmd, exit_code, stdout, stderr):
+        super().__init__(f"'{cmd}' exited with status {exit_code}: {stderr.strip()}")
+        self.cmd = cmd
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class PrepareFailed(HostError):
+    """
+    Setting up the host for building, conda or CUDA, failed.
+    """
+
+
+class BuildFailed(HostError):
+    """
+    The remote build finished with an error.
+    """
+
+
+class AsyncHost(Platform):
+    """
+    Asynchronous counterpart of Host for programmatic use, so that a single event loop can drive many hosts and builds.
+    Errors are reported with exceptions instead of exiting, all of them derived from HostError.
+    The channels are watched with loop.add_reader(), which the default ProactorEventLoop on Windows doesn't support, use
+    a SelectorEventLoop there, e.g. with asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy()).
+
+    Usage:
+        async with await AsyncHost.connect("1.2.3.4") as h:
+            await h.prepare()
+            await h.watch_prepare()
+            b = Build("llama.cpp", "main")
+            await b.upload_data_async(h)
+            await h.untar(h.path(b.tarfile), h.path("llama.cpp"))
+            await h.build(h.path("llama.cpp"))
+            async for line in h.watch_build(h.path("llama.cpp")):
+                print(line)
+    """
+    # Size of the chunks read from the SSH channels
+    chunk_size = 32768
+    # Maximum time to wait for channel activity before checking its state again, in seconds
+    poll_interval = 1
+
+    def __init__(self, host):
+        """
+        Initialize the instance, use connect() to get a connected one.
+        """
+        self.host = host
+        self.connection = None
+
+
+    @classmethod
+    async def connect(cls, host):
+        """
+        Connect to the host, detect its type and initialize it.
+        """
+        self = cls(host)
+        if await self.__test_connection(LINUX_USER, "uname -a", LINUX_TYPE):
+            self.set_type(LINUX_TYPE)
+        elif await self.__test_connection(WINDOWS_USER, "ver", WINDOWS_TYPE):
+            self.set_type(WINDOWS_TYPE)
+        else:
+            raise ConnectionFailed(f"Couldn't connect to host '{host}' or figure out what type it is")
+        await self.run(self.conda_init)
+        await self.mkdir(self.sisyphus_dir)
+        return self
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+    async def __test_connection(self, user, cmd, type):
+        """
+        Verify we can connect and run a test command in order to try and identify the host type.
+        """
+        logging.debug("Attempting to connect to '%s' assuming it's %s", self.host, type.capitalize())
+        self.connection = fabric.Connection(user=user, connect_timeout=10, host=self.host)
+        try:
+            # Connecting is blocking, only do that part in a thread
+            await asyncio.to_thread(self.connection.open)
+            r = await self.run(cmd)
+        except Exception:
+            logging.debug("Couldn't connect to host '%s' or it isn't '%s'", self.host, type.capitalize())
+            await self.close()
+            return False
+        else:
+            logging.debug(r)
+            logging.info("'%s' is a %s host", self.host, type.capitalize())
+            # Same keepalives and windows as Host, so that dead sessions are noticed quickly
+            self.link = Link(self.connection)
+            await asyncio.to_thread(self.link.tune)
+            return True
+
+
+    async def close(self):
+        """
+        Close the connection to the host.
+        """
+        if self.connection is not None:
+            await asyncio.to_thread(self.connection.close)
+
+
+    @contextlib.contextmanager
+    def __connection_errors(self):
+        """
+        Report the errors of the SSH and SFTP layers, paramiko.SSHException, EOFError, OSError..., as HostError.
+        Remote files that can't be accessed are plain HostError, anything else means the connection is broken.
+        """
+        try:
+            yield
+        except HostError:
+            raise
+        except OSError as e:
+            if isinstance(e, (ConnectionError, TimeoutError)) or e.errno is None:
+                raise ConnectionFailed(f"Connection to '{self.host}' failed: {e}") from e
+            raise HostError(f"Remote file access on '{self.host}' failed: {e}") from e
+        except Exception as e:
+            raise ConnectionFailed(f"Connection to '{self.host}' failed: {e}") from e
+
+
+    async def __communicate(self, channel):
+        """
+        Read the outputs of a channel until the remote command exits, without blocking the event loop.
+        """
+        loop = asyncio.get_running_loop()
+        activity = asyncio.Event()
+        # paramiko signals new data and closing of the channel through a pipe we can watch from the event loop
+        fd = channel.fileno()
+        loop.add_reader(fd, activity.set)
+        stdout = []
+        stderr = []
+        try:
+            while True:
+                activity.clear()
+                while channel.recv_ready():
+                    stdout.append(channel.recv(self.chunk_size))
+                while channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(self.chunk_size))
+                if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+                try:
+                    await asyncio.wait_for(activity.wait(), self.poll_interval)
+                except TimeoutError:
+                    pass
+        finally:
+            loop.remove_reader(fd)
+        return channel.recv_exit_status(), b"".join(stdout).decode(errors="replace"), b"".join(stderr).decode(errors="replace")
+
+
+    async def __exec(self, cmd):
+        """
+        Open a new channel on the connection and start a command.
+        """
+        def exec():
+            channel = self.connection.client.get_transport().open_session()
+            channel.exec_command(cmd)
+            return channel
+        return await asyncio.to_thread(exec)
+
+
+    async def run(self, cmd, strip=True):
+        """
+        Run a command on the remote host and return its output, raise CommandFailed if it fails.
+        The output is returned as is if strip is False, instead of without the leading and trailing whitespace.
+        """
+        logging.debug("Running '%s'", cmd)
+        with metrics.timer("run", bytes_up=len(cmd)) as t, self.__connection_errors():
+            channel = await self.__exec(cmd)
+            try:
+                exit_code, stdout, stderr = await self.__communicate(channel)
+            finally:
+                channel.close()
+            t.bytes_down = len(stdout) + len(stderr)
+        if exit_code != 0:
+            raise CommandFailed(cmd, exit_code, stdout, stderr)
+        if strip:
+            stdout = stdout.strip()
+        for line in stdout.splitlines():
+            logging.debug(line)
+        return stdout
+
+
+    async def run_async(self, cmd):
+        """
+        Launch a background command on the remote host, no error reporting since we're not waiting for exit.
+        """
+        logging.debug("Running asynchronously '%s'", cmd)
+        with metrics.timer("run_async", bytes_up=len(cmd)), self.__connection_errors():
+            channel = await self.__exec(cmd)
+            channel.close()
+
+
+    async def exists(self, path):
+        """
+        Check if remote file or directory exists.
+        """
+        return await self.run(self.exists_cmd(path)) == "Yes"
+
+
+    async def isdir(self, path):
+        """
+        Check if a remote path is a directory.
+        """
+        return await self.run(self.isdir_cmd(path)) == "Yes"
+
+
+    async def mkdir(self, path):
+        """
+        Create a remote directory.
+        """
+        if await self.exists(path):
+            if await self.isdir(path):
+                return
+            raise HostError(f"'{path}' already exists and is a file, can't create directory")
+        await self.run(self.mkdir_cmd(path))
+
+
+    async def ls(self, path):
+        """
+        List the contents of a remote directory.
+        """
+        return (await self.run(self.ls_cmd(path))).splitlines()
+
+
+    async def rm(self, path):
+        """
+        Delete a remote file or directory.
+        """
+        if await self.exists(path):
+            isdir = self.type == WINDOWS_TYPE and await self.isdir(path)
+            await self.run(self.rm_cmd(path, isdir))
+
+
+    async def put(self, source, dest):
+        """
+        Upload a local file to a remote directory.
+        """
+        if self.type == WINDOWS_TYPE:
+            dest = dest.replace("\\", "/")
+        logging.debug("Uploading '%s' to '%s'", source, dest)
+        with metrics.timer("put", bytes_up=os.path.getsize(source)), self.__connection_errors():
+            await asyncio.to_thread(self.connection.put, source, dest)
+
+
+    async def get(self, source, dest):
+        """
+        Download a remote file to a local path.
+        """
+        source = source.replace("\\", "/")
+        logging.debug("Downloading '%s' to '%s'", source, dest)
+        with metrics.timer("get") as t, self.__connection_errors():
+            r = await asyncio.to_thread(self.connection.get, source, dest)
+            t.bytes_down = os.path.getsize(r.local)
+
+
+    async def untar(self, filepath, dest):
+        """
+        Untar a remote file into a remote directory, creating the latter if needed.
+        """
+        await self.mkdir(dest)
+        await self.run(self.untar_cmd(filepath, dest))
+
+
+    async def open(self, path, mode="r"):
+        """
+        Open a remote file, the returned file object is blocking so use it from a thread.
+        """
+        if self.type == WINDOWS_TYPE:
+            path = path.replace("\\", "/")
+        logging.debug("Opening remote file '%s' with mode '%s'", path, mode)
+        with self.__connection_errors():
+            f = await asyncio.to_thread(self.connection.sftp().open, path, mode)
+            if "w" in mode or "a" in mode:
+                f.set_pipelined(True)
+            else:
+                f.prefetch()
+        return metrics.File(f, "open")
+
+
+    async def prepare(self):
+        """
+        Start setting up the host for building, use watch_prepare() to wait for it to finish.
+        """
+        await self.mkdir(self.sisyphus_dir)
+        envs = await self.run("conda env list")
+        if any(line.startswith("sisyphus ") for line in envs.splitlines()):
+            logging.info("Environment 'sisyphus' already exists")
+            await self.run(f"{self.touch} {self.path("conda.ready")}")
+        else:
+            await self.run_async(self.create_env_cmd())
+            logging.info("Environment 'sisyphus' is being created")
+
+        # Windows hosts need to have CUDA installed by the user
+        if self.type == WINDOWS_TYPE:
+            if await self.exists(self.path("cuda_driver.log")) or await self.exists(self.path("cuda_12.3.0.log")):
+                logging.info("CUDA is already installed or being installed")
+            else:
+                await self.run_async(self.install_cuda_cmd())
+                logging.info("CUDA is being installed")
+
+
+    async def watch_prepare(self, wait=3):
+        """
+        Wait for the host setup to finish, raise PrepareFailed if it fails.
+        """
+        names = ["conda", "cuda"] if self.type == WINDOWS_TYPE else ["conda"]
+        for name in names:
+            while True:
+                ready, failed = await asyncio.gather(self.exists(self.path(f"{name}.ready")),
+                                                     self.exists(self.path(f"{name}.failed")))
+                if ready:
+                    break
+                if failed:
+                    raise PrepareFailed(f"Setting up {name} on '{self.host}' failed")
+                await asyncio.sleep(wait)
+
+
+    async def build(self, workdir, channels=()):
+        """
+        Start building the feedstock uploaded to a remote work directory, use watch_build() to follow it.
+        """
+        await self.mkdir(self.path_join(workdir, "build"))
+        await self.run_async(self.build_cmd(workdir, channels))
+
+
+    async def status(self, package):
+        """
+        Return the build status.
+        """
+        files = await self.ls(self.path(package))
+        if "build.ready" in files:
+            return "Complete"
+        if "build.failed" in files:
+            return "Failed"
+        if "build.log" in files:
+            return "Building"
+        return "Not started"
+
+
+    async def watch_build(self, workdir, wait=3, max_lines=1000):
+        """
+        Iterate asynchronously over the lines of the build log as they come in, raise BuildFailed if the build fails.
+        """
+        logfile = self.path_join(workdir, "build.log")
+        lines_read = 0
+        while True:
+            # Check for the build.ready or build.failed files before reading the log so that we don't miss the last lines
+            ready, failed = await asyncio.gather(self.exists(self.path_join(workdir, "build.ready")),
+                                                 self.exists(self.path_join(workdir, "build.failed")))
+            # Blank lines and indentation count, so that lines_read matches what was actually read
+            lines = (await self.run(self.tail_cmd(logfile, lines_read, max_lines), strip=False)).splitlines()
+            for line in lines:
+                yield line
+            lines_read += len(lines)
+            # There may be more lines waiting, read them right away, and before trusting the markers
+            if len(lines) >= max_lines:
+                continue
+            # Quit watching when the build.ready or build.failed files show up
+            if ready:
+                return
+            if failed:
+                raise BuildFailed(f"Build in '{workdir}' failed")
+            await asyncio.sleep(wait)
@@ -1,17 +1,21 @@
+import asyncio
+import io
 import logging
-import os
 import tarfile
 import tempfile
+import time
 import zipfile
 
-from . import util
+from . import metrics, util
+from .host import CBC_YAML
 
 
 CBC_URL = "https://raw.githubusercontent.com/AnacondaRecipes/aggregate/master/conda_build_config.yaml"
 GITHUB_API="https://api.github.com/repos/AnacondaRecipes/"
 FEEDSTOCK_PREFIX="https://github.com/AnacondaRecipes/"
 FEEDSTOCK_SUFFIX="-feedstock"
-CBC_YAML = "conda_build_config.yaml"
+SPOOL_SIZE = 64 * 1024 * 1024
+RECIPES = ("recipe/meta.yaml", "recipe/recipe.yaml")
 
 
 class Build:
@@ -28,40 +32,72 @@ class Build:
         self.branch = branch
         logging.info("Branch: %s", self.branch)
 
+        # Contents of the recipe, picked up while uploading the data
+        self.recipe = None
 
-    def __patch_cbc(self):
+
+    def __patch_cbc(self, cbc):
         """
         Patch the Conda build config.
         """
-        cbc_path = os.path.join(self.workdir, CBC_YAML)
-        logging.debug("Patching '%s'", cbc_path)
-
-        # Load the file
-        with open(cbc_path, "r") as f:
-            cbc = f.read()
+        logging.debug("Patching '%s'", CBC_YAML)
 
         # Patch it
         cbc = cbc.replace("vs2019", "vs2022")
         # Add anything else here as needed
 
-        # Rewrite it in place
-        with open(cbc_path, "w") as f:
-            f.write(cbc)
         logging.info("Patched '%s'", CBC_YAML)
+        return cbc
 
 
-    def upload_data(self, host):
+    def __add_file(self, tf, name, data):
         """
-        Prepare the data locally instead of doing that on the host, which is inconvenient especially on Windows.
+        Add a file to a tarball from memory.
         """
-        tmpdir = tempfile.TemporaryDirectory()
-        self.workdir = tmpdir.name
-        logging.debug("Local work directory: %s", self.workdir)
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        tf.addfile(info, io.BytesIO(data))
+
 
-        # Download and patch the Conda build config
-        util.download(CBC_URL, os.path.join(self.workdir, CBC_YAML))
+    def __add_feedstock(self, tf, zip_file):
+        """
+        Copy the feedstock from the GitHub zip archive to a tarball, renaming its top directory to 'feedstock' on the fly.
+        """
+        for member in zip_file.infolist():
+            # Every member is under a '<package>-feedstock-<branch>' directory we rename to 'feedstock' so that the name
+            # is known after we upload everything to the host
+            _, _, subpath = member.filename.rstrip("/").partition("/")
+            name = "feedstock/" + subpath if subpath else "feedstock"
+
+            info = tarfile.TarInfo(name)
+            info.mtime = time.mktime(member.date_time + (0, 0, -1))
+            if member.is_dir():
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tf.addfile(info)
+            elif subpath in RECIPES:
+                # Keep the recipe around so we can figure out the dependencies between packages
+                data = zip_file.read(member)
+                self.recipe = data.decode("utf-8")
+                info.size = len(data)
+                tf.addfile(info, io.BytesIO(data))
+            else:
+                info.size = member.file_size
+                with zip_file.open(member) as f:
+                    tf.addfile(info, f)
+
+
+    def __download(self):
+        """
+        Download the Conda build config and the feedstock, return the patched config and the feedstock zip archive.
+        """
+        # Download and patch the Conda build config, it's small enough to keep in memory
+        with io.BytesIO() as f:
+            util.stream(CBC_URL, f)
+            cbc = f.getvalue().decode("utf-8")
         logging.info("Downloaded '%s'", CBC_YAML)
-        self.__patch_cbc()
+        cbc = self.__patch_cbc(cbc)
 
         # If the feedstock branch isn't set we need to figure out what is the default for this repository
         if not self.branch:
@@ -71,28 +107,54 @@ class Build:
 
         # We download an archive so we don't need to have git installed and shell out to it (which is ugly)
         feedstock_url = FEEDSTOCK_PREFIX + self.package + FEEDSTOCK_SUFFIX + "/archive/refs/heads/" + self.branch + ".zip"
-        zip_file_path = os.path.join(self.workdir, self.package + "_" + self.branch + ".zip")
 
-        # Save the archive as a file because we don't want to clobber RAM
-        util.download(feedstock_url, zip_file_path)
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_ref:
-            zip_ref.extractall(self.workdir)
+        # Zip archives need to be seekable so we can't read them straight from the network, keep it in memory unless
+        # it's big enough that we don't want to clobber RAM
+        zf = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        try:
+            util.stream(feedstock_url, zf)
+        except BaseException:
+            zf.close()
+            raise
+        zf.seek(0)
         logging.info("Downloaded feedstock")
+        return cbc, zf
 
-        # Rename the feedstock directory to 'feedstock' so that the name is known after we upload everything to the host
-        with zipfile.ZipFile(zip_file_path, 'r') as zip_file:
-            feedstock_dir_name = zip_file.namelist()[0].split("/")[0]
-        os.rename(os.path.join(self.workdir, feedstock_dir_name), os.path.join(self.workdir, "feedstock"))
 
-        # tar the data because uploading recursively to a Windows host is a major pain
+    def __write(self, remote, cbc, zf):
+        """
+        Write the data tarball to an open remote file.
+        """
+        # tar the data because uploading recursively to a Windows host is a major pain, and write the tarball
+        # directly to the host
+        with zipfile.ZipFile(zf, "r") as zip_file, tarfile.open(fileobj=remote, mode="w|") as tf:
+            self.__add_file(tf, CBC_YAML, cbc.encode("utf-8"))
+            self.__add_feedstock(tf, zip_file)
+
+
+    @metrics.tagged
+    def upload_data(self, host):
+        """
+        Prepare the data locally instead of doing that on the host, which is inconvenient especially on Windows.
+        The data is streamed from GitHub to the host without being extracted or written to the local disk.
+        """
+        cbc, zf = self.__download()
+        self.tarfile = self.package + ".tar"
+        with zf, host.open(host.path(self.tarfile), "wb") as remote:
+            self.__write(remote, cbc, zf)
+        logging.info("Data archive uploaded")
+
+
+    async def upload_data_async(self, host):
+        """
+        Same as upload_data() for an AsyncHost, the downloads and the upload run in threads.
+        """
+        cbc, zf = await asyncio.to_thread(self.__download)
         self.tarfile = self.package + ".tar"
-        os.chdir(self.workdir)
-        with tarfile.open(self.tarfile, "a") as tf:
-            tf.add(CBC_YAML)
-            tf.add("feedstock")
-        logging.info("Data archive ready to upload")
-
-        # Finally upload the data to the host
-        # We're doing it from within this method because the temporary directory is very volatile
-        host.put(self.tarfile, host.sisyphus_dir)
+        with zf:
+            remote = await host.open(host.path(self.tarfile), "wb")
+            try:
+                await asyncio.to_thread(self.__write, remote, cbc, zf)
+            finally:
+                await asyncio.to_thread(remote.close)
         logging.info("Data archive uploaded")
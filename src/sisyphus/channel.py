@@ -0,0 +1,245 @@
+import bz2
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import tarfile
+import tempfile
+
+from . import registry
+
+
+EXTENSIONS = (".tar.bz2", ".conda")
+CHUNK_SIZE = 1024 * 1024
+INDEX_JSON = "info/index.json"
+ZIP_LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+
+
+class IndexReader:
+    """
+    Pick the metadata of a package out of its info/index.json file while the package is being streamed, so that it
+    doesn't have to be read again once written. It's fed the raw chunks of the package, and stops decompressing as soon
+    as the file is found, which is early since the info files come first.
+    """
+    def __init__(self, filename):
+        self.record = None
+        self.done = False
+        # Decompressed tar data not parsed yet, and how many bytes of the current member to skip
+        self.tar = b""
+        self.skip = 0
+        self.name = None
+        # .conda packages are zip archives containing a zstd compressed tarball of the info files, zip data not parsed
+        # yet, how many bytes of the current member to skip, and how many are left in the info tarball
+        self.conda = filename.endswith(".conda")
+        self.zip = b""
+        self.zip_skip = 0
+        self.member = 0
+        self.decompressor = None if self.conda else bz2.BZ2Decompressor()
+
+
+    def feed(self, chunk):
+        if self.done:
+            return
+        try:
+            if self.conda:
+                self.__feed_zip(chunk)
+            else:
+                self.__feed_tar(self.decompressor.decompress(chunk))
+        except Exception as e:
+            logging.debug("Reading the metadata failed: %s", e)
+            self.done = True
+
+
+    def __feed_zip(self, chunk):
+        """
+        Walk the local headers of the zip archive until the info tarball, and decompress it.
+        """
+        self.zip += chunk
+        while not self.done:
+            if self.zip_skip:
+                skipped = min(self.zip_skip, len(self.zip))
+                self.zip = self.zip[skipped:]
+                self.zip_skip -= skipped
+                if self.zip_skip:
+                    return
+            if self.member > 0:
+                # In the middle of the info tarball
+                data, self.zip = self.zip[:self.member], self.zip[self.member:]
+                self.member -= len(data)
+                self.__feed_tar(self.decompressor.decompress(data))
+                if self.member == 0:
+                    self.done = True
+                return
+            if len(self.zip) < ZIP_LOCAL_HEADER.size:
+                return
+            signature, _, flags, method, _, _, _, size, _, name_size, extra_size = ZIP_LOCAL_HEADER.unpack_from(self.zip)
+            # Sizes after the data can't be streamed, and the central directory means we've seen every member
+            if signature != b"PK\x03\x04" or flags & 0x08:
+                self.done = True
+                return
+            start = ZIP_LOCAL_HEADER.size + name_size + extra_size
+            if len(self.zip) < start:
+                return
+            name = self.zip[ZIP_LOCAL_HEADER.size:ZIP_LOCAL_HEADER.size + name_size].decode()
+            if name.startswith("info-") and name.endswith(".tar.zst") and method == 0:
+                try:
+                    import zstandard
+                except ImportError:
+                    logging.debug("zstandard isn't installed, can't read the metadata of .conda packages")
+                    self.done = True
+                    return
+                self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+                self.member = size
+            else:
+                self.zip_skip = size
+            self.zip = self.zip[start:]
+
+
+    def __feed_tar(self, data):
+        """
+        Walk the headers of the tarball until info/index.json, skipping the data of the other members.
+        """
+        self.tar += data
+        while not self.done:
+            if self.skip:
+                skipped = min(self.skip, len(self.tar))
+                self.tar = self.tar[skipped:]
+                self.skip -= skipped
+                if self.skip:
+                    return
+            if len(self.tar) < tarfile.BLOCKSIZE:
+                return
+            header = self.tar[:tarfile.BLOCKSIZE]
+            if header == tarfile.NUL * tarfile.BLOCKSIZE:
+                # End of the archive
+                self.done = True
+                return
+            info = tarfile.TarInfo.frombuf(header, "utf-8", "surrogateescape")
+            padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            if info.type in (tarfile.GNUTYPE_LONGNAME, tarfile.XHDTYPE) or (info.isfile() and self.__name(info) == INDEX_JSON):
+                if len(self.tar) < tarfile.BLOCKSIZE + padded:
+                    return
+                content = self.tar[tarfile.BLOCKSIZE:tarfile.BLOCKSIZE + info.size]
+                self.tar = self.tar[tarfile.BLOCKSIZE + padded:]
+                if info.type == tarfile.GNUTYPE_LONGNAME:
+                    self.name = content.rstrip(tarfile.NUL).decode()
+                elif info.type == tarfile.XHDTYPE:
+                    # Records are '<length> <key>=<value>\n', we only care about the path
+                    m = re.search(rb"\d+ path=([^\n]*)\n", content)
+                    self.name = m.group(1).decode() if m else None
+                else:
+                    self.record = json.loads(content)
+                    self.done = True
+                continue
+            self.name = None
+            self.tar = self.tar[tarfile.BLOCKSIZE:]
+            self.skip = padded
+
+
+    def __name(self, info):
+        """
+        Name of a member, which comes from the previous header for long names.
+        """
+        return (self.name or info.name).removeprefix("./")
+
+
+class LocalChannel:
+    """
+    A local conda channel packages are streamed into, its repodata.json files are updated incrementally with just the
+    new packages instead of reindexing the whole channel.
+    """
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        # Packages added but not indexed yet, (subdir, filename) -> {"md5", "sha256", "size"} and index.json contents
+        self.pending = {}
+
+
+    def add(self, filename, f, subdir):
+        """
+        Stream a package into the channel, computing its checksums and reading its metadata as it's written.
+        """
+        directory = os.path.join(self.path, subdir)
+        os.makedirs(directory, exist_ok=True)
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        index = IndexReader(filename)
+        size = 0
+        # Write to a temporary file first so that an interrupted download never leaves a truncated package behind
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while chunk := f.read(CHUNK_SIZE):
+                    md5.update(chunk)
+                    sha256.update(chunk)
+                    index.feed(chunk)
+                    size += len(chunk)
+                    out.write(chunk)
+            os.replace(tmp, os.path.join(directory, filename))
+        except BaseException:
+            os.remove(tmp)
+            raise
+        logging.info("Added '%s/%s' to the channel", subdir, filename)
+        checksums = {"md5": md5.hexdigest(), "sha256": sha256.hexdigest(), "size": size}
+        self.pending[(subdir, filename)] = (checksums, index.record)
+
+
+    def add_tar(self, f):
+        """
+        Stream all the packages contained in an uncompressed tarball into the channel, then index them.
+        """
+        with tarfile.open(fileobj=f, mode="r|") as tar:
+            for member in tar:
+                # Windows hosts can produce either kind of separators
+                parts = re.split(r"[\\/]", member.name)
+                if not member.isfile() or not parts[-1].endswith(EXTENSIONS) or len(parts) < 2:
+                    continue
+                self.add(parts[-1], tar.extractfile(member), parts[-2])
+        self.index()
+
+
+    def __load(self, subdir):
+        """
+        Load the repodata.json file of a subdir, or create an empty one.
+        """
+        try:
+            with open(os.path.join(self.path, subdir, "repodata.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"info": {"subdir": subdir}, "packages": {}, "packages.conda": {}, "repodata_version": 1}
+
+
+    def index(self):
+        """
+        Add the pending packages to the repodata.json files of their subdirs.
+        """
+        repodata = {}
+        for (subdir, filename), (checksums, record) in sorted(self.pending.items()):
+            if subdir not in repodata:
+                repodata[subdir] = self.__load(subdir)
+            if record is None and filename.endswith(".conda"):
+                # Without zstandard, use the metadata of the .tar.bz2 version of the same package if we have it, which
+                # is the case after transmuting
+                bz2_filename = filename[:-len(".conda")] + ".tar.bz2"
+                record = (self.pending.get((subdir, bz2_filename), (None, None))[1]
+                          or repodata[subdir].get("packages", {}).get(bz2_filename))
+                if record is not None:
+                    record = {k: v for k, v in record.items() if k not in ("md5", "sha256", "size")}
+            if record is None:
+                logging.error("Couldn't read the metadata of '%s/%s', it won't be installable", subdir, filename)
+                if filename.endswith(".conda"):
+                    logging.warning("Install zstandard to index .conda packages without a .tar.bz2 version")
+                continue
+            record = dict(record, **checksums)
+            key = "packages.conda" if filename.endswith(".conda") else "packages"
+            repodata[subdir].setdefault(key, {})[filename] = record
+        self.pending = {}
+
+        # conda insists on noarch being there even when it's empty
+        if not os.path.exists(os.path.join(self.path, "noarch", "repodata.json")):
+            repodata.setdefault("noarch", self.__load("noarch"))
+        for subdir, data in repodata.items():
+            os.makedirs(os.path.join(self.path, subdir), exist_ok=True)
+            registry.write_json(os.path.join(self.path, subdir, "repodata.json"), data)
+            logging.debug("Updated '%s/repodata.json'", subdir)
@@ -1,11 +1,18 @@
+import base64
 import fabric
 import logging
 import os
 import re
+import shlex
 import shutil
 import tarfile
 import time
 
+from . import metrics
+from .powershell import PowerShell, exists_script, follow_script, isdir_script, ls_script, mkdir_script, rm_script
+from .script import MARKER, Script
+from .transport import Link, ResumableFile
+
 
 LINUX_TYPE = "linux"
 WINDOWS_TYPE = "windows"
@@ -16,37 +23,313 @@ WINDOWS_TOPDIR = "\\tmp"    # not the root of a device like / or \\
 CONDA_PACKAGES = "conda-build distro-tooling::anaconda-linter git anaconda-client conda-package-handling"
 BUILD_OPTIONS = "--error-overlinking -c ai-staging"
 ACTIVATE = "conda activate sisyphus &&"
+CBC_YAML = "conda_build_config.yaml"
+RECONNECT_ATTEMPTS = 5
+# A build that hasn't written to its log for that many seconds is considered dead, e.g. killed by a reboot of the host
+STALLED_BUILD = 2 * 60 * 60
 
 
-class Host:
-    def __init__(self, host):
+class Platform:
+    """
+    Host type specific settings and command syntax, shared by the synchronous and asynchronous hosts.
+    """
+    def set_type(self, type):
         """
-        Detect the remote host type and initialize the instance.
+        Initialize the settings for the given host type.
         """
-        self.host = host
-
-        if self.__test_connection(LINUX_USER, "uname -a", LINUX_TYPE):
-            self.type = LINUX_TYPE
+        self.type = type
+        if self.type == LINUX_TYPE:
             self.user = LINUX_USER
             self.separator = "/"
             self.topdir = LINUX_TOPDIR
             self.touch = "touch"
             self.cat = "cat"
-            self.run("conda init")
+            self.devnull = "/dev/null"
+            self.conda_init = "conda init"
             self.pkgdir = "linux-64"
-        elif self.__test_connection(WINDOWS_USER, "ver", WINDOWS_TYPE):
-            self.type = WINDOWS_TYPE
+        elif self.type == WINDOWS_TYPE:
             self.user = WINDOWS_USER
             self.separator = "\\"
             self.topdir = WINDOWS_TOPDIR
             self.touch = "copy nul"
             self.cat = "type"
-            self.run("C:\\miniconda3\\Scripts\\conda.exe init")
+            self.devnull = "nul"
+            self.conda_init = "C:\\miniconda3\\Scripts\\conda.exe init"
             self.pkgdir = "win-64"
+        self.sisyphus_dir = self.path_join(self.topdir, "sisyphus")
+
+
+    def path_join(self, *paths):
+        """
+        Join paths with the host separator.
+        """
+        path = self.separator.join(list(paths))
+        # We need to deduplicate separators but, sadly, re.sub doesn't work here (because, you guessed it, Windows)
+        cleaned_path = ""
+        for c in path:
+            if len(cleaned_path) > 0 and c == self.separator and cleaned_path[-1] == self.separator:
+                continue
+            cleaned_path += c
+        return cleaned_path
+
+
+    def path(self, *paths):
+        """
+        Build a path on the host from the Sisyphus directory and the given paths.
+        """
+        return self.path_join(self.sisyphus_dir, *paths)
+
+
+    def channel_url(self, path):
+        """
+        URL of a channel in a remote directory, for conda.
+        """
+        if self.type == LINUX_TYPE:
+            return f"file://{path}"
+        elif self.type == WINDOWS_TYPE:
+            # Paths don't have a volume name, and conda is installed on C: anyway
+            return "file:///C:" + path.replace("\\", "/")
+
+
+    def exists_cmd(self, path):
+        """
+        Command printing 'Yes' if a remote file or directory exists.
+        """
+        if self.type == LINUX_TYPE:
+            # Using single-quotes for the variable to avoid expansion
+            return f"if [[ -e '{path}' ]]; then echo Yes; fi"
+        elif self.type == WINDOWS_TYPE:
+            # Windows wants double-quotes for the variable
+            return f'if exist "{path}" echo Yes'
+
+
+    def isdir_cmd(self, path):
+        """
+        Command printing 'Yes' if a remote path is a directory.
+        """
+        if self.type == LINUX_TYPE:
+            return f"if [[ -d '{path}' ]]; then echo Yes; fi"
+        elif self.type == WINDOWS_TYPE:
+            return f'if exist "{path}\\*" echo Yes'
+
+
+    def mkdir_cmd(self, path):
+        """
+        Command creating a remote directory.
+        """
+        if self.type == LINUX_TYPE:
+            return f"mkdir -p {path}"
+        elif self.type == WINDOWS_TYPE:
+            return f'mkdir "{path}"'
+
+
+    def ls_cmd(self, path):
+        """
+        Command listing the contents of a remote directory, one per line.
+        """
+        if self.type == LINUX_TYPE:
+            return f"ls -1A {path}"
+        elif self.type == WINDOWS_TYPE:
+            return f'dir /b "{path}"'
+
+
+    def rm_cmd(self, path, isdir):
+        """
+        Command deleting a remote file or directory, Windows needs to know which one it is.
+        """
+        if self.type == LINUX_TYPE:
+            return f"rm -rf {path}"
+        elif self.type == WINDOWS_TYPE:
+            if isdir:
+                return f'rd /s /q "{path}"'
+            else:
+                return f'del "{path}"'
+
+
+    def grep_cmd(self, path, patterns, context=0, ignore_case=False):
+        """
+        Command printing the lines of a remote file matching any of the regular expressions, and the lines around them.
+        Each line is printed as '<line number>:<byte offset>:<line>', with '-' instead of ':' for context lines.
+        """
+        if self.type == LINUX_TYPE:
+            options = f"-n -b -E -C {context}" + (" -i" if ignore_case else "")
+            expressions = " ".join(f"-e {shlex.quote(p)}" for p in patterns)
+            # grep exits with 1 when nothing matches, which isn't an error for us
+            return f"grep {options} {expressions} -- '{path}'; [ $? -le 1 ]"
+        elif self.type == WINDOWS_TYPE:
+            # Select-String doesn't give byte offsets, so use the same .NET regular expressions in a loop reading the file
+            # while it's being written, keeping the previous lines in a queue for context.
+            # Offsets assume lines end with CRLF.
+            regex = "|".join(f"(?:{p})" for p in patterns).replace("'", "''")
+            match = "-match" if ignore_case else "-cmatch"
+            script = (f"$p='{regex}';$c={context};$n=0;$o=0;$a=0;$q=New-Object System.Collections.Queue;"
+                      f"$r=New-Object System.IO.StreamReader((New-Object System.IO.FileStream('{path.replace("'", "''")}','Open','Read','ReadWrite')));"
+                      "while(($l=$r.ReadLine()) -ne $null){$n++;"
+                      f"if($l {match} $p){{while($q.Count){{$q.Dequeue()}};'{{0}}:{{1}}:{{2}}' -f $n,$o,$l;$a=$c}}"
+                      "elseif($a -gt 0){'{0}-{1}-{2}' -f $n,$o,$l;$a--}"
+                      "elseif($c -gt 0){$q.Enqueue(('{0}-{1}-{2}' -f $n,$o,$l));if($q.Count -gt $c){[void]$q.Dequeue()}};"
+                      "$o+=[Text.Encoding]::UTF8.GetByteCount($l)+2}")
+            # The patterns can contain anything cmd would interpret, like double quotes or %VAR%, so pass the script
+            # encoded instead of quoting it
+            encoded = base64.b64encode(script.encode("utf-16-le")).decode()
+            return f"powershell -NoProfile -EncodedCommand {encoded}"
+
+
+    def builds_cmd(self):
+        """
+        Command describing every package work directory on the host, for monitoring. The output is the current time
+        followed, for each package, by 'package <name>', 'file <name> <mtime> <size>' for each build.* file,
+        'last <last line of the log>' and 'du <disk usage in KiB>'.
+        """
+        files = ("build.started", "build.log", "build.ready", "build.failed")
+        if self.type == LINUX_TYPE:
+            return (f"cd '{self.sisyphus_dir}' && date +%s && for d in */; do d=${{d%/}}; "
+                    f'[ -e "$d/{CBC_YAML}" ] || continue; echo "package $d"; '
+                    f'for f in {" ".join(files)}; do [ -e "$d/$f" ] && stat -c "file $f %Y %s" "$d/$f"; done; '
+                    'echo "last $(tail -n 1 "$d/build.log" 2>/dev/null)"; echo "du $(du -sk "$d" | cut -f1)"; done; true')
+        elif self.type == WINDOWS_TYPE:
+            names = ",".join(f"'{f}'" for f in files)
+            script = ("[DateTimeOffset]::UtcNow.ToUnixTimeSeconds();"
+                      f"foreach($d in Get-ChildItem '{self.sisyphus_dir}' -Directory){{"
+                      f"if(!(Test-Path (Join-Path $d.FullName '{CBC_YAML}'))){{continue}};'package '+$d.Name;"
+                      f"foreach($f in {names}){{$p=Join-Path $d.FullName $f;if(Test-Path $p){{$i=Get-Item $p;"
+                      "'file {0} {1} {2}' -f $f,([DateTimeOffset]$i.LastWriteTimeUtc).ToUnixTimeSeconds(),$i.Length}};"
+                      "$p=Join-Path $d.FullName 'build.log';if(Test-Path $p){'last '+(Get-Content $p -Tail 1)}else{'last '};"
+                      "'du '+[math]::Floor(((Get-ChildItem $d.FullName -Recurse -File -Force -ErrorAction SilentlyContinue|"
+                      "Measure-Object Length -Sum).Sum)/1024)}")
+            return f'powershell -NoProfile -Command "{script}"'
+
+
+    def mkdir_if_missing_cmd(self, path):
+        """
+        Command creating a remote directory unless it already exists.
+        """
+        if self.type == LINUX_TYPE:
+            return self.mkdir_cmd(path)
+        elif self.type == WINDOWS_TYPE:
+            return f'if not exist "{path}\\*" {self.mkdir_cmd(path)}'
+
+
+    def rm_if_exists_cmd(self, path):
+        """
+        Command deleting a remote file or directory if it exists, without having to know which one it is.
+        """
+        if self.type == LINUX_TYPE:
+            return self.rm_cmd(path, True)
+        elif self.type == WINDOWS_TYPE:
+            return f'if exist "{path}\\*" ({self.rm_cmd(path, True)}) else (if exist "{path}" {self.rm_cmd(path, False)})'
+
+
+    def untar_cmd(self, filepath, dest):
+        """
+        Command extracting a remote tarball into an existing remote directory.
+        """
+        return f"tar -x -f {filepath} -C {dest}"
+
+
+    def idle_cmd(self, path):
+        """
+        Command printing how many seconds ago a remote file was last modified, according to the clock of the host.
+        """
+        if self.type == LINUX_TYPE:
+            return f'echo $(( $(date +%s) - $(stat -c %Y "{path}") ))'
+        elif self.type == WINDOWS_TYPE:
+            return (f"powershell -NoProfile -Command \"[int]((Get-Date) - (Get-Item -LiteralPath '{path}').LastWriteTime)"
+                    ".TotalSeconds\"")
+
+
+    def create_env_cmd(self):
+        """
+        Background command creating the sisyphus environment, then touching conda.ready or conda.failed.
+        """
+        touch = f"{self.touch} {self.path("conda.")}"
+        conda_cmd = f"conda create -y -n sisyphus {CONDA_PACKAGES}"
+        redirect = f"{self.path("conda.log")} 2>&1"
+        return f"{conda_cmd} > {redirect} && {touch}ready || {touch}failed"
+
+
+    def install_cuda_cmd(self):
+        """
+        Background command installing CUDA on Windows hosts, then touching cuda.ready or cuda.failed.
+        """
+        # Using multiple powershell calls from cmd because the && operator doesn't exist in the old version we're using
+        start = "powershell -ExecutionPolicy ByPass -File \\prefect\\install_"
+        middle = f".ps1 > {self.sisyphus_dir}\\"
+        end = ".log 2>&1"
+        cuda_driver = f"{start}cuda_driver{middle}cuda_driver{end}"
+        cuda_12_3_0 = f"{start}cuda_12.3.0{middle}cuda_12.3.0{end}"
+        touch = f"{self.touch} {self.path("cuda.")}"
+        return f"{cuda_driver} && {cuda_12_3_0} && {touch}ready || {touch}failed"
+
+
+    def build_cmd(self, workdir, channels=()):
+        """
+        Background command building the feedstock in a remote work directory, touching build.started first then
+        build.ready or build.failed.
+        """
+        builddir = self.path_join(workdir, "build")
+        cbc = self.path_join(workdir, CBC_YAML)
+        feedstock = self.path_join(workdir, "feedstock")
+        logfile = self.path_join(workdir, "build.log")
+        options = "".join(f"-c {c} " for c in channels) + BUILD_OPTIONS
+        cmd = f"conda build {options} -e {cbc} --croot={builddir} {feedstock}"
+        touch = f"{self.touch} {self.path_join(workdir, "build.")}"
+        return f"{touch}started && {ACTIVATE} {cmd} > {logfile} 2>&1 && {touch}ready || {touch}failed"
+
+
+    def tail_cmd(self, logfile, skip, max_lines):
+        """
+        Command printing the first max_lines of a remote file after skipping its first lines, nothing if it doesn't
+        exist yet, which is usually the case right after starting a build.
+        """
+        if self.type == LINUX_TYPE:
+            # tail counts lines from 1
+            return f'if [ -e "{logfile}" ]; then tail -n +{skip + 1} "{logfile}" | head -n {max_lines}; fi'
+        elif self.type == WINDOWS_TYPE:
+            return (f'if exist "{logfile}" powershell -Command '
+                    f'"Get-Content {logfile} | Select-Object -Skip {skip} -First {max_lines}"')
+
+
+    def script_cmd(self, cmds, stop_on_error):
+        """
+        Combine commands into a single one printing a marker line with the exit code after each of them.
+        The script always exits successfully, the steps after a failure don't run if stop_on_error is True.
+        """
+        steps = []
+        if self.type == LINUX_TYPE:
+            for i, cmd in enumerate(cmds):
+                # Subshells so that changing directories doesn't affect the next steps
+                step = f"( {cmd} ) 2>&1; rc=$?; printf '\\n{MARKER} {i} %d\\n' $rc"
+                if stop_on_error:
+                    step += "; [ $rc -eq 0 ] || exit 0"
+                steps.append(step)
+            return "\n".join(steps)
+        elif self.type == WINDOWS_TYPE:
+            # Everything has to fit on a single line for cmd, and %errorlevel% would be expanded before running it, so
+            # exit codes are reduced to 0 or 1
+            stop = " & exit /b 0" if stop_on_error else ""
+            for i, cmd in enumerate(cmds):
+                steps.append(f"(({cmd}) 2>&1 & if errorlevel 1 (echo. & echo {MARKER} {i} 1{stop}) else (echo. & echo {MARKER} {i} 0))")
+            return " & ".join(steps)
+
+
+class Host(Platform):
+    def __init__(self, host):
+        """
+        Detect the remote host type and initialize the instance.
+        """
+        self.host = host
+        # Persistent PowerShell session on Windows hosts, started on first use, False if it doesn't work
+        self.__shell = None
+
+        if self.__test_connection(LINUX_USER, "uname -a", LINUX_TYPE):
+            self.set_type(LINUX_TYPE)
+        elif self.__test_connection(WINDOWS_USER, "ver", WINDOWS_TYPE):
+            self.set_type(WINDOWS_TYPE)
         else:
             logging.error("Couldn't connect to host '%s' or figure out what type it is", self.host)
             raise SystemExit(1)
-        self.sisyphus_dir = self.path_join(self.topdir, "sisyphus")
+        self.run(self.conda_init)
         self.mkdir(self.sisyphus_dir)
 
 
@@ -65,67 +348,118 @@ class Host:
         else:
             logging.debug(r.stdout.lstrip().rstrip())
             logging.info("'%s' is a %s host", self.host, type.capitalize())
+            self.link = Link(self.connection)
+            self.link.tune()
             return True
 
 
-    def path_join(self, *paths):
+    def reconnect(self):
         """
-        Join paths with the host separator.
+        Replace a dead connection with a new one, retrying with an increasing delay for a while.
         """
-        path = self.separator.join(list(paths))
-        # We need to deduplicate separators but, sadly, re.sub doesn't work here (because, you guessed it, Windows)
-        cleaned_path = ""
-        for c in path:
-            if len(cleaned_path) > 0 and c == self.separator and cleaned_path[-1] == self.separator:
+        # The PowerShell session goes with the connection, a new one will be started when needed
+        if self.__shell:
+            self.__shell.close()
+        self.__shell = None
+        self.connection.close()
+        for attempt in range(RECONNECT_ATTEMPTS):
+            logging.warning("Connection to '%s' lost, reconnecting", self.host)
+            connection = fabric.Connection(user=self.user, connect_timeout=self.link.timeout, host=self.host)
+            try:
+                connection.open()
+            except Exception as e:
+                logging.debug("Reconnecting failed: %s", e)
+                time.sleep(min(2 ** attempt, 30))
                 continue
-            cleaned_path += c
-        return cleaned_path
-
-
-    def path(self, *paths):
-        """
-        Build a path on the host from the Sisyphus directory and the given paths.
-        """
-        return self.path_join(self.sisyphus_dir, *paths)
+            # Keep what we learned about the throughput, it's unlikely to have changed much
+            link = Link(connection)
+            link.throughput = self.link.throughput
+            link.tune()
+            self.connection, self.link = connection, link
+            logging.info("Reconnected to '%s'", self.host)
+            return
+        logging.error("Couldn't reconnect to '%s'", self.host)
+        raise SystemExit(1)
 
 
-    def run(self, cmd, quiet=False):
+    def run(self, cmd, quiet=False, retry=False, strip=True):
         """
         Wrapper to run a command on the remote host, log automatically, and report errors if any.
+        If retry is True the command is run again after reconnecting if the connection died, which is only safe for
+        commands that don't change anything, since we can't know how far they got.
+        The output is returned as is if strip is False, instead of without the leading and trailing whitespace.
         """
         try:
-            r = self.connection.run(cmd, hide=True)
+            try:
+                with metrics.timer("run", bytes_up=len(cmd)) as t:
+                    r = self.connection.run(cmd, hide=True)
+                    t.bytes_down = len(r.stdout)
+            except Exception as e:
+                # The command failed on its own, not because the connection died
+                if not retry or getattr(e, "result", None) is not None or self.link.alive():
+                    raise
+                self.reconnect()
+                with metrics.timer("run", bytes_up=len(cmd)) as t:
+                    r = self.connection.run(cmd, hide=True)
+                    t.bytes_down = len(r.stdout)
         except Exception as e:
             if not quiet:
                 logging.error("%s", e)
                 raise SystemExit(1)
         else:
             logging.debug("Running '%s'", cmd)
-            stdout = r.stdout.lstrip().rstrip()
+            stdout = r.stdout.strip() if strip else r.stdout
             for line in stdout.splitlines():
                 logging.debug(line)
             return stdout
 
 
+    def powershell(self, script):
+        """
+        Run a line of PowerShell in the persistent session on Windows hosts, which saves starting a new process.
+        Return its output, or None if there's no session, in which case the caller falls back to a cmd command.
+        """
+        if self.type != WINDOWS_TYPE or self.__shell is False:
+            return None
+        try:
+            if self.__shell is None:
+                logging.debug("Starting a PowerShell session")
+                self.__shell = PowerShell(self.connection)
+            with metrics.timer("powershell", bytes_up=len(script)) as t:
+                ok, output = self.__shell.run(script)
+                t.bytes_down = len(output)
+        except Exception as e:
+            logging.debug("PowerShell session unavailable, falling back to cmd: %s", e)
+            if self.__shell:
+                self.__shell.close()
+            self.__shell = False
+            return None
+        logging.debug("Running in PowerShell '%s'", script)
+        for line in output.splitlines():
+            logging.debug(line)
+        if not ok:
+            logging.error("%s", output.strip())
+            raise SystemExit(1)
+        return output
+
+
     def run_async(self, cmd):
         """
         Launch a background command on the remote host, no error reporting since we're not waiting for exit.
         """
         logging.debug("Running asynchronously '%s'", cmd)
-        self.connection.run(cmd, asynchronous=True)
+        with metrics.timer("run_async", bytes_up=len(cmd)):
+            self.connection.run(cmd, asynchronous=True)
 
 
     def exists(self, path):
         """
         Check if remote file or directory exists
         """
-        if self.type == LINUX_TYPE:
-            # Using single-quotes for the variable to avoid expansion
-            r = self.run(f"if [[ -e '{path}' ]]; then echo Yes; fi")
-        elif self.type == WINDOWS_TYPE:
-            # Windows wants double-quotes for the variable
-            r = self.run(f'if exist "{path}" echo Yes')
-        if r == "Yes":
+        r = self.powershell(exists_script(path))
+        if r is None:
+            r = self.run(self.exists_cmd(path), retry=True)
+        if r.strip() == "Yes":
             logging.debug("'%s' exists", path)
             return True
         else:
@@ -137,11 +471,10 @@ class Host:
         """
         Check if a remote path is a directory.
         """
-        if self.type == LINUX_TYPE:
-            r = self.run(f"if [[ -d '{path}' ]]; then echo Yes; fi")
-        elif self.type == WINDOWS_TYPE:
-            r = self.run(f'if exist "{path}\\*" echo Yes')
-        if r == "Yes":
+        r = self.powershell(isdir_script(path))
+        if r is None:
+            r = self.run(self.isdir_cmd(path), retry=True)
+        if r.strip() == "Yes":
             logging.debug("'%s' is a directory", path)
             return True
         else:
@@ -153,6 +486,9 @@ class Host:
         """
         Create a remote directory.
         """
+        # All in one go with PowerShell
+        if self.powershell(mkdir_script(path)) is not None:
+            return
         if self.exists(path):
             if self.isdir(path):
                 logging.debug("Directory '%s' already exists")
@@ -160,20 +496,16 @@ class Host:
             else:
                 logging.error("'%s' already exists and is a file, can't create directory")
                 raise SystemExit(1)
-        if self.type == LINUX_TYPE:
-            self.run(f"mkdir -p {path}")
-        elif self.type == WINDOWS_TYPE:
-            self.run(f'mkdir "{path}"')
+        self.run(self.mkdir_cmd(path))
 
 
     def ls(self, path):
         """
         Outputs a simple list of the contents of a remote directory.
         """
-        if self.type == LINUX_TYPE:
-            out = self.run(f"ls -1A {path}")
-        elif self.type == WINDOWS_TYPE:
-            out = self.run(f'dir /b "{path}"')
+        out = self.powershell(ls_script(path))
+        if out is None:
+            out = self.run(self.ls_cmd(path), retry=True)
         return out.splitlines()
 
 
@@ -181,14 +513,13 @@ class Host:
         """
         Delete a remote file or directory.
         """
+        # All in one go with PowerShell
+        if self.powershell(rm_script(path)) is not None:
+            return
         if self.exists(path):
-            if self.type == LINUX_TYPE:
-                self.run(f"rm -rf {path}")
-            elif self.type == WINDOWS_TYPE:
-                if self.isdir(path):
-                    self.run(f'rd /s /q "{path}"')
-                else:
-                    self.run(f'del "{path}"')
+            # Only Windows needs to know whether it's a directory or not
+            isdir = self.type == WINDOWS_TYPE and self.isdir(path)
+            self.run(self.rm_cmd(path, isdir))
 
 
     def untar(self, filepath, dest):
@@ -197,9 +528,10 @@ class Host:
         """
         # Create the destination directory in case it doesn't exist
         self.mkdir(dest)
-        self.run(f"tar -x -f {filepath} -C {dest}")
+        self.run(self.untar_cmd(filepath, dest))
 
 
+    @metrics.tagged
     def prepare(self):
         """
         Prepare the remote host for building.
@@ -209,7 +541,6 @@ class Host:
 
         # Does the sisyphus environment exist?
         found = False
-        touch = f"{self.touch} {self.path("conda.")}"
         r = self.run("conda env list")
         for line in r.splitlines():
             if line.startswith("sisyphus "):
@@ -217,12 +548,10 @@ class Host:
                 break
         if found:
             logging.info("Environment 'sisyphus' already exists")
-            self.run(f"{touch}ready")
+            self.run(f"{self.touch} {self.path("conda.ready")}")
         else:
             # It doesn't, so let's create it
-            conda_cmd = f"conda create -y -n sisyphus {CONDA_PACKAGES}"
-            redirect = f"{self.path("conda.log")} 2>&1"
-            self.run_async(f"{conda_cmd} > {redirect} && {touch}ready || {touch}failed")
+            self.run_async(self.create_env_cmd())
             logging.info("Environment 'sisyphus' is being created")
 
         # Windows hosts need to have CUDA installed by the user
@@ -230,14 +559,7 @@ class Host:
             if self.exists(self.path("cuda_driver.log")) or self.exists(self.path("cuda_12.3.0.log")):
                 logging.info("CUDA is already installed or being installed")
             else:
-                # Using multiple powershell calls from cmd because the && operator doesn't exist in the old version we're using
-                start = "powershell -ExecutionPolicy ByPass -File \\prefect\\install_"
-                middle = f".ps1 > {self.sisyphus_dir}\\"
-                end = ".log 2>&1"
-                cuda_driver = f"{start}cuda_driver{middle}cuda_driver{end}"
-                cuda_12_3_0 = f"{start}cuda_12.3.0{middle}cuda_12.3.0{end}"
-                touch = f"{self.touch} {self.path("cuda.")}"
-                self.run_async(f"{cuda_driver} && {cuda_12_3_0} && {touch}ready || {touch}failed")
+                self.run_async(self.install_cuda_cmd())
                 logging.info("CUDA is being installed")
 
 
@@ -249,24 +571,62 @@ class Host:
         if self.type == WINDOWS_TYPE:
             dest = dest.replace("\\", "/")
         logging.debug("Uploading '%s' to '%s'", source, dest)
-        self.connection.put(source, dest)
+        size = os.path.getsize(source)
+        start = time.perf_counter()
+        with metrics.timer("put", bytes_up=size):
+            self.connection.put(source, dest)
+        self.link.record(size, time.perf_counter() - start)
+
+
+    def get(self, source):
+        """
+        Download a remote file to the current directory.
+        """
+        # Same as put()
+        source = source.replace("\\", "/")
+        logging.debug("Downloading '%s'", source)
+        start = time.perf_counter()
+        with metrics.timer("get") as t:
+            # Resumes where it was if the connection dies
+            f = ResumableFile(self, source)
+            try:
+                with open(source.rsplit("/", 1)[-1], "wb") as local:
+                    shutil.copyfileobj(f, local, 1024 * 1024)
+            finally:
+                f.close()
+            t.bytes_down = f.position
+        self.link.record(f.position, time.perf_counter() - start)
 
 
-    def build(self, workdir):
+    def open(self, path, mode="r"):
+        """
+        Open a remote file, mostly to stream data to or from it without going through a local file.
+        """
+        # Same as put(), fabric and paramiko want forward slashes
+        if self.type == WINDOWS_TYPE:
+            path = path.replace("\\", "/")
+        logging.debug("Opening remote file '%s' with mode '%s'", path, mode)
+        # Reads resume where they were if the connection dies, writes can't since the data is usually streamed
+        if "w" not in mode and "a" not in mode:
+            return metrics.File(ResumableFile(self, path), "open")
+        f = self.connection.sftp().open(path, mode)
+        # Don't wait for the server to acknowledge every single write
+        f.set_pipelined(True)
+        return metrics.File(f, "open")
+
+
+    @metrics.tagged
+    def build(self, workdir, channels=()):
         """
         Build a feedstock with the conda config both in a remote directory.
+        Additional channels, like the build directories of other packages, take precedence over the default ones.
         """
-        builddir = self.path_join(workdir, "build")
-        cbc = self.path_join(workdir, "conda_build_config.yaml")
-        feedstock = self.path_join(workdir, "feedstock")
-        logfile = self.path_join(workdir, "build.log")
-        cmd = f"conda build {BUILD_OPTIONS} -e {cbc} --croot={builddir} {feedstock}"
-        touch = f"{self.touch} {self.path_join(workdir, "build.")}"
-        self.mkdir(builddir)
-        self.run_async(f"{ACTIVATE} {cmd} > {logfile} 2>&1 && {touch}ready || {touch}failed")
+        self.mkdir(self.path_join(workdir, "build"))
+        self.run_async(self.build_cmd(workdir, channels))
         logging.info("Build is running")
 
 
+    @metrics.tagged
     def watch_build(self, workdir):
         """
         Show the build process in real-time.
@@ -277,30 +637,54 @@ class Host:
         max_lines = 1000
 
         logfile = self.path_join(workdir, "build.log")
-        if self.type == LINUX_TYPE:
-            skip_pre = 'tail -n +'
-            skip_post = f' "{logfile}" | tail -n {max_lines}'
-        elif self.type == WINDOWS_TYPE:
-            skip_pre = f'powershell -Command "Get-Content {logfile} | Select-Object -Skip '
-            skip_post = f' | Select-Object -Last {max_lines}"'
-
+        ready_file = self.path_join(workdir, "build.ready")
+        failed_file = self.path_join(workdir, "build.failed")
         lines_read = 0
         while True:
-            r = self.run(f'{skip_pre}{lines_read}{skip_post}')
-            lines = r.splitlines()
+            # On Windows, PowerShell keeps the log open between calls instead of starting a new process every time
+            out = self.powershell(follow_script(logfile, lines_read, ready_file, failed_file, max_lines))
+            if out is not None:
+                lines = out.splitlines()
+                ready, failed = (value == "True" for value in lines.pop(0).split())
+            else:
+                # Check for the build.ready or build.failed files and read the log in a single round-trip, checking
+                # first so that we don't miss the last lines
+                s = Script(self)
+                ready = s.exists(ready_file)
+                failed = s.exists(failed_file)
+                # Errors mustn't end up in the log lines
+                tail = s.run(self.tail_cmd(logfile, lines_read, max_lines), stderr=False)
+                s.execute(retry=True)
+                ready, failed = ready.value, failed.value
+                lines = tail.output.splitlines()
             for line in lines:
                 logging.info(line)
             lines_read += len(lines)
+            # There may be more lines waiting, read them right away, and before trusting the markers
+            if len(lines) >= max_lines:
+                continue
             # Quit watching when the build.ready or build.failed files show up
-            if self.exists(self.path_join(workdir, "build.ready")):
+            if ready:
                 logging.info("Build complete")
                 break
-            if self.exists(self.path_join(workdir, "build.failed")):
+            if failed:
                 logging.error("Build Failed")
                 raise SystemExit(1)
             time.sleep(wait)
 
 
+    def __poll(self, name):
+        """
+        Check for both the <name>.ready and <name>.failed files in a single round-trip.
+        """
+        s = Script(self)
+        ready = s.exists(self.path(f"{name}.ready"))
+        failed = s.exists(self.path(f"{name}.failed"))
+        s.execute(retry=True)
+        return ready.value, failed.value
+
+
+    @metrics.tagged
     def watch_prepare(self):
         """
         Watch the prepare process.
@@ -311,10 +695,11 @@ class Host:
         error = False
         messaged = False
         while True:
-            if self.exists(self.path("conda.ready")):
+            ready, failed = self.__poll("conda")
+            if ready:
                 logging.info("Conda is ready")
                 break
-            elif self.exists(self.path("conda.failed")):
+            elif failed:
                 logging.warning("Conda setup failed")
                 error = True
                 break
@@ -326,10 +711,11 @@ class Host:
         if self.type == WINDOWS_TYPE:
             messaged = False
             while True:
-                if self.exists(self.path("cuda.ready")):
+                ready, failed = self.__poll("cuda")
+                if ready:
                     logging.info("CUDA is ready")
                     break
-                elif self.exists(self.path("cuda.failed")):
+                elif failed:
                     logging.warning("CUDA installation failed")
                     error = True
                     break
@@ -342,6 +728,7 @@ class Host:
             raise SystemExit(1)
 
 
+    @metrics.tagged
     def upload(self, package, channel, token):
         """
         Upload build packages to anaconda.org.
@@ -353,6 +740,7 @@ class Host:
         logging.info("Done")
 
 
+    @metrics.tagged
     def status(self, package):
         """
         Print the build status.
@@ -367,6 +755,54 @@ class Host:
         return "Not started"
 
 
+    @metrics.tagged
+    def stalled(self, package):
+        """
+        Check whether a build that hasn't finished stopped logging long enough ago that it's most likely dead.
+        """
+        idle = int(self.run(self.idle_cmd(self.path(package, "build.log")), retry=True))
+        logging.debug("The log of '%s' was last written %d seconds ago", package, idle)
+        return idle > STALLED_BUILD
+
+
+    @metrics.tagged
+    def builds(self):
+        """
+        Return the status, timing, last log line and disk usage of every package on the host, in one round-trip.
+        """
+        now = None
+        builds = {}
+        for line in self.run(self.builds_cmd()).splitlines():
+            key, _, value = line.partition(" ")
+            if now is None:
+                now = int(line)
+            elif key == "package":
+                b = builds[value] = {"files": {}, "last": "", "du": 0}
+            elif key == "file":
+                name, mtime, size = value.split()
+                b["files"][name] = (int(mtime), int(size))
+            elif key == "last":
+                b["last"] = value
+            elif key == "du" and value.isdigit():
+                b["du"] = int(value) * 1024
+        for b in builds.values():
+            files = b["files"]
+            # Same logic as status()
+            if "build.ready" in files:
+                b["status"] = "Complete"
+            elif "build.failed" in files:
+                b["status"] = "Failed"
+            elif "build.log" in files:
+                b["status"] = "Building"
+            else:
+                b["status"] = "Not started"
+            end = files.get("build.ready", files.get("build.failed", (now, 0)))[0]
+            b["elapsed"] = max(end - files["build.started"][0], 0) if "build.started" in files else None
+            b["log_size"] = files.get("build.log", (0, 0))[1]
+        return builds
+
+
+    @metrics.tagged
     def wait(self, package):
         """
         Download build tarballs from the remote host.
@@ -384,13 +820,11 @@ class Host:
                 logging.info("Waiting for build to start")
             else:
                 logging.info("Waiting for the build to finish")
-            # Close the connection because over a very long time it can silently die
-            self.connection.close()
+            # No need to reopen the connection in case it silently died, run() notices and reconnects
             time.sleep(wait)
-            # Re-open the connection
-            self.connection = fabric.Connection(user=self.user, connect_timeout=10, host=self.host)
 
 
+    @metrics.tagged
     def log(self, package, no_wait=False):
         """
         Print the build log to standard output.
@@ -404,82 +838,125 @@ class Host:
         print(r)
 
 
-    def download(self, package, destination, all=False):
+    @metrics.tagged
+    def grep(self, package, patterns, context=0, ignore_case=False):
         """
-        Download build tarballs from the remote host.
+        Search the build log on the host, return a list of (line number, byte offset, is match, line) tuples.
         """
-        # Wait for the build to finish
-        self.wait(package)
+        logfile = self.path(package, "build.log")
+        r = self.run(self.grep_cmd(logfile, patterns, context, ignore_case))
+        results = []
+        for line in r.splitlines():
+            m = re.match(r"^(\d+)([:-])(\d+)[:-](.*)$", line)
+            # Skip the separators between groups of lines
+            if m:
+                results.append((int(m.group(1)), int(m.group(3)), m.group(2) == ":", m.group(4)))
+        return results
 
-        # Transmute packages if needed
-        self.transmute(package)
 
-        # Check whether there are packaes to download, if not bail out
-        builddir = self.path(package, "build")
-        pkgdir = self.path_join(builddir, self.pkgdir)
-        files = [self.path_join(self.pkgdir, f) for f in self.ls(pkgdir) if f.endswith('.tar.bz2') or f.endswith('.conda')]
-        if not files:
-            logging.warning("No packages to download")
-            return
+    @metrics.tagged
+    def download(self, package, destination, all=False, journal=None, channel=None):
+        """
+        Download build tarballs from the remote host.
+        If a local channel is given, the packages are streamed straight into it instead of the destination directory.
+        If a journal is given, the completed steps are recorded in it and skipped when resuming an interrupted download.
+        """
+        done = journal.done if journal else lambda step: False
+        record = journal.record if journal else lambda step, **data: None
+        channel_path = channel.path if channel else None
+        # Steps recorded with other options don't apply, e.g. a tarball with the whole work directory or packages
+        # downloaded to a directory instead of the channel
+        if journal and ((done("tar") and journal.get("tar", "all") != all) or
+                        (done("get") and journal.get("get", "channel") != channel_path)):
+            logging.info("The previous download used other options, starting over")
+            journal.clear()
 
         tf_name = f"sisyphus_{package}_{self.type}.tar"
         tf = self.path_join(self.topdir, tf_name)
+        dest = os.path.join(destination, package)
 
+        if not done("tar"):
+            # Wait for the build to finish
+            self.wait(package)
 
-        # Create a tarball containing either just packages or the whole build directory
-        try:
-            if all:
-                logging.info("Downloading complete Sisyphus data at '%s'", self.sisyphus_dir)
-                self.run(f"cd {self.topdir} && tar -cf {tf} sisyphus")
-            else:
-                logging.info("Downloading %d package tarballs in '%s'", len(files), pkgdir)
-                if self.type == LINUX_TYPE:
-                    self.run(f"cd {builddir} && tar -cf {tf} {" ".join(files)} 2>/dev/null || true")
-                elif self.type == WINDOWS_TYPE:
-                    self.run(f'cd {builddir} && tar -cf {tf} {" ".join(files)} 2>nul )', quiet=True)
-
-        except Exception as e:
-            logging.error(f"Failed to create tar file: {str(e)}")
-            raise SystemExit(1)
-
-        # Verify the tar file was created
-        if not self.exists(tf):
-            logging.error("Tar file '%s' is missing", tf)
-            raise SystemExit(1)
+            # Transmute packages if needed
+            if not done("transmute"):
+                self.transmute(package)
+                record("transmute")
+
+            # Check whether there are packaes to download, if not bail out
+            builddir = self.path(package, "build")
+            pkgdir = self.path_join(builddir, self.pkgdir)
+            files = [self.path_join(self.pkgdir, f) for f in self.ls(pkgdir) if f.endswith('.tar.bz2') or f.endswith('.conda')]
+            if not files:
+                logging.warning("No packages to download")
+                if journal:
+                    journal.clear()
+                return
 
-        # Download and untar it
-        dest = os.path.join(destination, package)
-        # Create the local destination directory if it doesn't exist
-        try:
-            os.makedirs(dest)
-        except:
-            pass
-        # Delete the previous builds for the same package if any
-        try:
-            if all:
-                shutil.rmtree(os.path.join(dest, "sisyphus"))
-            else:
-                shutil.rmtree(os.path.join(dest, self.pkgdir))
-        except:
-            pass
-        os.chdir(dest)
+            # Create a tarball containing either just packages or the whole build directory
+            try:
+                if all:
+                    logging.info("Downloading complete Sisyphus data at '%s'", self.sisyphus_dir)
+                    self.run(f"cd {self.topdir} && tar -cf {tf} sisyphus")
+                else:
+                    logging.info("Downloading %d package tarballs in '%s'", len(files), pkgdir)
+                    if self.type == LINUX_TYPE:
+                        self.run(f"cd {builddir} && tar -cf {tf} {" ".join(files)} 2>/dev/null || true")
+                    elif self.type == WINDOWS_TYPE:
+                        self.run(f'cd {builddir} && tar -cf {tf} {" ".join(files)} 2>nul )', quiet=True)
+
+            except Exception as e:
+                logging.error(f"Failed to create tar file: {str(e)}")
+                raise SystemExit(1)
+            record("tar", all=all)
+
+        if not done("get") or (not channel and not os.path.exists(os.path.join(dest, tf_name))):
+            # Verify the tar file was created
+            if not self.exists(tf):
+                logging.error("Tar file '%s' is missing", tf)
+                if journal:
+                    journal.clear()
+                raise SystemExit(1)
 
-        logging.debug(f"Attempting to download from remote path: {tf}")
-        try:
-            self.connection.get(tf.replace("\\", "/"))
-        except Exception as e:
-            logging.error(f"Download failed for {tf}: {str(e)}")
-            raise SystemExit(1)
-        with tarfile.open(tf_name, "r") as tar:
-            tar.extractall()
+            logging.debug(f"Attempting to download from remote path: {tf}")
+            try:
+                if channel:
+                    with self.open(tf, "rb") as f:
+                        channel.add_tar(f)
+                else:
+                    # Create the local destination directory if it doesn't exist
+                    os.makedirs(dest, exist_ok=True)
+                    os.chdir(dest)
+                    self.get(tf)
+            except Exception as e:
+                logging.error(f"Download failed for {tf}: {str(e)}")
+                raise SystemExit(1)
+            record("get", channel=channel_path)
+
+        if not channel:
+            # Delete the previous builds for the same package if any, and untar the new ones
+            os.chdir(dest)
+            try:
+                if all:
+                    shutil.rmtree(os.path.join(dest, "sisyphus"))
+                else:
+                    shutil.rmtree(os.path.join(dest, self.pkgdir))
+            except:
+                pass
+            with tarfile.open(tf_name, "r") as tar:
+                tar.extractall()
+            os.remove(tf_name)
 
         # Cleanup
-        os.remove(tf_name)
         self.rm(tf)
+        if journal:
+            journal.clear()
 
         logging.info("Done")
 
 
+    @metrics.tagged
     def transmute(self, package):
         """
         Transmute .tar.bz2 packages to .conda packages.
@@ -0,0 +1,60 @@
+import json
+import logging
+import os
+import re
+import time
+
+from . import registry
+
+
+class Journal:
+    """
+    Local record of the steps a command has completed for a package on a host, so that it can resume where it left off
+    if it's interrupted by the local machine sleeping, the VPN dropping, etc...
+    """
+    def __init__(self, command, host, package):
+        directory = os.path.join(registry.home(), "journal")
+        os.makedirs(directory, exist_ok=True)
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", f"{command}_{host}_{package}")
+        self.path = os.path.join(directory, name + ".json")
+        try:
+            with open(self.path) as f:
+                self.steps = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.steps = {}
+        if self.steps:
+            logging.info("Resuming from previous run, completed steps: %s", ", ".join(self.steps))
+
+
+    def done(self, step):
+        """
+        Check if a step has been completed.
+        """
+        return step in self.steps
+
+
+    def get(self, step, key, default=None):
+        """
+        Get data recorded with a completed step.
+        """
+        return self.steps.get(step, {}).get(key, default)
+
+
+    def record(self, step, **data):
+        """
+        Record a step as completed, along with any data needed to resume after it.
+        """
+        logging.debug("Journal: '%s' done", step)
+        self.steps[step] = dict(data, time=time.time())
+        registry.write_json(self.path, self.steps)
+
+
+    def clear(self):
+        """
+        Forget everything, the next run will start from scratch.
+        """
+        self.steps = {}
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
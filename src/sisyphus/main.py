@@ -1,10 +1,11 @@
+import atexit
 import click
 import logging
 import os
 
-from .build import Build
-from .host import Host
-from .util import create_gpu_instance, stop_instance
+# Only the lightweight modules are imported here, the commands import what they need themselves so that the ones that
+# don't talk to a host, and --help, don't pay for loading fabric, paramiko and the rocket-platform client
+from . import metrics, registry
 
 
 HELP_CONTEXT = dict(help_option_names=["-h", "--help"])
@@ -33,9 +34,27 @@ def setup_logging(log_level):
     logging.basicConfig(level=level, format=format)
 
 
+def connect(host):
+    """
+    Establish communication with the host and remember it for the commands working on all hosts.
+    """
+    from .host import Host
+
+    h = Host(host)
+    registry.add_host(host, h.type)
+    return h
+
+
 @click.group(context_settings=HELP_CONTEXT)
-def cli():
-    pass
+@click.option("--metrics-out", type=click.Path(dir_okay=False),
+              help="Save counts, latencies and bytes transferred of the remote operations to this file on exit.")
+@click.option("--metrics-format", type=click.Choice(["json", "prometheus"]), default="json", show_default=True,
+              help="Format of the metrics file.")
+def cli(metrics_out, metrics_format):
+    metrics.set_command(click.get_current_context().invoked_subcommand)
+    if metrics_out:
+        # Using atexit so that the metrics are also saved when exiting on error
+        atexit.register(metrics.registry.dump, metrics_out, metrics_format)
 
 
 @cli.command(context_settings=HELP_CONTEXT)
@@ -49,7 +68,7 @@ def prepare(host, log_level):
     setup_logging(log_level)
 
     # Establish communication with the host
-    h = Host(host)
+    h = connect(host)
 
     # Create work directories, setup conda, install CUDA if necessary, etc...
     h.prepare()
@@ -63,40 +82,114 @@ def prepare(host, log_level):
 @click.option("-P", "--package", required=True, help="Name of the package to build.")
 @click.option("-B", "--branch", help="Branch to build from in the feedstock's repository.")
 @click.option("--no-watch", is_flag=True, default=False, help="Don't watch the build process after it starts.")
+@click.option("--restart", is_flag=True, default=False,
+              help="Start over instead of resuming an interrupted run or reattaching to a running build.")
 @click.option("-l", "--log-level", type=click.Choice(["error", "warning", "info", "debug"], case_sensitive=False),
               default="info", show_default=True, help="Logging level.")
-def build(package, branch, host, no_watch, log_level):
+def build(package, branch, host, no_watch, restart, log_level):
     """
     Build a package on the host.
     """
+    from .build import Build
+    from .journal import Journal
+    from .script import Script
+
     setup_logging(log_level)
 
     # Establish communication with the host
-    h = Host(host)
-
-    # Prepare the host for building, it will automatically figure out if it has already run or not
-    h.prepare()
-
-    # Prepare and upload the data to the host
-    b = Build(package, branch)
-    b.upload_data(h)
+    h = connect(host)
     workdir = h.path(package)
-    tarfile = h.path(b.tarfile)
-    # Start from a blank slate, untar the data and cleanup
-    h.rm(workdir)
-    h.untar(tarfile, workdir)
-    h.rm(tarfile)
-    logging.info("Data ready on host")
 
-    # Wait for prepare to finish if necesary
-    h.watch_prepare()
+    # Keep track of the steps completed so that running the same command again resumes where it stopped
+    journal = Journal("build", host, package)
+    if restart or (journal.done("upload") and journal.get("upload", "branch") != branch):
+        journal.clear()
+    if journal.done("build") and not h.exists(workdir):
+        logging.warning("The work directory of the previous build is gone, starting over")
+        journal.clear()
+
+    # Don't clobber a build that's already running, e.g. started from another machine, unless it died without finishing
+    running = not restart and h.exists(workdir) and h.status(package) == "Building"
+    if running and h.stalled(package):
+        logging.warning("The build of '%s' on the host stopped logging a long time ago without finishing, starting over",
+                        package)
+        journal.clear()
+        running = False
+    if not journal.done("build") and running:
+        logging.warning("A build of '%s' is already running on the host, reattaching to it", package)
+        journal.record("build")
+
+    if not journal.done("build"):
+        # Prepare the host for building, it will automatically figure out if it has already run or not
+        if not journal.done("prepare"):
+            h.prepare()
+            journal.record("prepare")
+
+        # Prepare and upload the data to the host, unless it's already there
+        tarfile = h.path(journal.get("upload", "tarfile", f"{package}.tar"))
+        if not journal.done("upload") or (not journal.done("untar") and not h.exists(tarfile)):
+            b = Build(package, branch)
+            b.upload_data(h)
+            tarfile = h.path(b.tarfile)
+            journal.record("upload", branch=branch, tarfile=b.tarfile)
+
+        # Start from a blank slate, untar the data and cleanup, all in one go
+        if not journal.done("untar"):
+            s = Script(h)
+            s.rm(workdir)
+            s.untar(tarfile, workdir)
+            s.rm(tarfile)
+            s.execute()
+            journal.record("untar")
+        logging.info("Data ready on host")
+
+        # Wait for prepare to finish if necesary
+        h.watch_prepare()
 
-    # Create a build directory, and build the package
-    h.build(workdir)
+        # Create a build directory, and build the package
+        h.build(workdir)
+        journal.record("build")
 
     # Start watching the build process if not disabled
-    if not no_watch:
+    if no_watch:
+        # Nothing left to resume, running the command again will reattach to the build while it's running
+        journal.clear()
+        return
+    try:
         h.watch_build(workdir)
+    except SystemExit:
+        # Only forget about the build if it actually failed, not if the connection dropped while watching it
+        if h.status(package) == "Failed":
+            journal.clear()
+        raise
+    journal.clear()
+
+
+@cli.command(context_settings=HELP_CONTEXT)
+@click.option("-H", "--host", required=True, help="IP or FQDN of the build host.")
+@click.option("-P", "--package", "packages", multiple=True,
+              help="Name of a package to build, optionally followed by ':<branch>'. Can be repeated.")
+@click.option("-f", "--file", type=click.Path(exists=True, dir_okay=False),
+              help="Pipeline spec file listing one package per line, optionally followed by a branch.")
+@click.option("-j", "--jobs", type=int, default=2, show_default=True, help="Maximum number of builds running at once.")
+@click.option("-l", "--log-level", type=click.Choice(["error", "warning", "info", "debug"], case_sensitive=False),
+              default="info", show_default=True, help="Logging level.")
+def pipeline(host, packages, file, jobs, log_level):
+    """
+    Build several packages on the host, in the order required by their dependencies.
+    """
+    from .pipeline import Pipeline, parse_spec
+
+    setup_logging(log_level)
+
+    specs = [(p.partition(":")[0], p.partition(":")[2] or None) for p in packages]
+    if file:
+        specs += parse_spec(file)
+    if not specs:
+        raise click.UsageError("At least one package must be specified with -P or in a file with -f")
+
+    h = connect(host)
+    Pipeline(h, specs, jobs).run()
 
 
 @cli.command(context_settings=HELP_CONTEXT)
@@ -111,7 +204,7 @@ def watch(host, package, log_level):
     """
     setup_logging(log_level)
 
-    h = Host(host)
+    h = connect(host)
     if package:
         h.watch_build(h.path(package))
     else:
@@ -131,7 +224,7 @@ def upload(host, package, channel, token, log_level):
     """
     setup_logging(log_level)
 
-    h = Host(host)
+    h = connect(host)
     h.upload(package, channel, token)
 
 
@@ -147,29 +240,68 @@ def log(host, package, no_wait, log_level):
     """
     setup_logging(log_level)
 
-    h = Host(host)
+    h = connect(host)
     h.log(package, no_wait)
 
 
+@cli.command(context_settings=HELP_CONTEXT)
+@click.option("-H", "--host", required=True, help="IP or FQDN of the build host.")
+@click.option("-P", "--package", required=True, help="Name of the package being built.")
+@click.option("-e", "--regexp", "patterns", required=True, multiple=True,
+              help="Regular expression to search for, can be repeated to search for several at once.")
+@click.option("-C", "--context", type=int, default=0, show_default=True, help="Number of lines to show around matches.")
+@click.option("-i", "--ignore-case", is_flag=True, help="Ignore case distinctions.")
+@click.option("-l", "--log-level", type=click.Choice(["error", "warning", "info", "debug"], case_sensitive=False),
+              default="info", show_default=True, help="Logging level.")
+def grep(host, package, patterns, context, ignore_case, log_level):
+    """
+    Search the build log on the host and print matching lines with their line number and byte offset.
+    Set exit code to 1 if nothing matches.
+    """
+    setup_logging(log_level)
+
+    h = connect(host)
+    results = h.grep(package, patterns, context, ignore_case)
+    previous = None
+    for number, offset, match, line in results:
+        # Separate non-contiguous groups of lines like grep does
+        if previous is not None and number > previous + 1:
+            print("--")
+        separator = ":" if match else "-"
+        print(f"{number}{separator}{offset}{separator}{line}")
+        previous = number
+    if not any(match for _, _, match, _ in results):
+        raise SystemExit(1)
+
+
 @cli.command(context_settings=HELP_CONTEXT)
 @click.option("-H", "--host", required=True, help="IP or FQDN of the build host.")
 @click.option("-P", "--package", required=True, help="Name of the package being built.")
 @click.option("-d", "--destination", help="Destination directory.")
 @click.option("-a", "--all", is_flag=True, help="Download the whole work directory for debugging.")
+@click.option("-c", "--channel", type=click.Path(file_okay=False),
+              help="Local conda channel to add the packages to, indexing them as they're downloaded.")
 @click.option("-l", "--log-level", type=click.Choice(["error", "warning", "info", "debug"], case_sensitive=False),
               default="info", show_default=True, help="Logging level.")
-def download(host, package, destination, all, log_level):
+def download(host, package, destination, all, channel, log_level):
     """
     Download built packages from the remote host.
     """
+    from .channel import LocalChannel
+    from .journal import Journal
+
     setup_logging(log_level)
 
     # The default desitination is the current working directory
     if not destination:
         destination = os.getcwd()
 
-    h = Host(host)
-    h.download(package, destination, all)
+    if channel and all:
+        logging.error("--channel can't be used with --all")
+        raise SystemExit(1)
+
+    h = connect(host)
+    h.download(package, destination, all, Journal("download", host, package), LocalChannel(channel) if channel else None)
 
 
 @cli.command(context_settings=HELP_CONTEXT)
@@ -183,7 +315,7 @@ def transmute(host, package, log_level):
     """
     setup_logging(log_level)
 
-    h = Host(host)
+    h = connect(host)
     h.transmute(package)
 
 
@@ -198,10 +330,34 @@ def status(host, package, log_level):
     """
     setup_logging(log_level)
 
-    h = Host(host)
+    h = connect(host)
     print(h.status(package))
 
 
+@cli.command(context_settings=HELP_CONTEXT)
+@click.option("-H", "--host", "hosts", multiple=True,
+              help="IP or FQDN of a build host, can be repeated. [default: all the hosts Sisyphus has used]")
+@click.option("-n", "--interval", type=float, default=5, show_default=True, help="Seconds between refreshes.")
+@click.option("-j", "--jobs", type=int, default=8, show_default=True, help="Maximum number of hosts polled at once.")
+@click.option("--once", is_flag=True, help="Print the status once and exit instead of refreshing.")
+@click.option("-l", "--log-level", type=click.Choice(["error", "warning", "info", "debug"], case_sensitive=False),
+              default="warning", show_default=True, help="Logging level.")
+def top(hosts, interval, jobs, once, log_level):
+    """
+    Show a live view of the builds on all hosts.
+    """
+    from .top import Dashboard
+
+    setup_logging(log_level)
+
+    if not hosts:
+        hosts = sorted(registry.list_hosts())
+    if not hosts:
+        raise click.UsageError("No known hosts, specify some with -H")
+
+    Dashboard(list(hosts), jobs).run(interval, once)
+
+
 @cli.command(context_settings=HELP_CONTEXT)
 @click.option("-H", "--host", required=True, help="IP or FQDN of the build host.")
 @click.option("-P", "--package", required=True, help="Name of the package being built.")
@@ -213,14 +369,16 @@ def wait(host, package, log_level):
     """
     setup_logging(log_level)
 
-    h = Host(host)
+    h = connect(host)
     if not h.wait(package):
         raise SystemExit(1)
 
 
 @cli.command(context_settings=HELP_CONTEXT)
-@click.option("--linux", is_flag=True, help="Create a Linux GPU instance.")
-@click.option("--windows", is_flag=True, help="Create a Windows GPU instance.")
+@click.option("--linux", is_flag=True, help="Create Linux GPU instances.")
+@click.option("--windows", is_flag=True, help="Create Windows GPU instances.")
+@click.option("-n", "--count", type=click.IntRange(min=1), default=1, show_default=True,
+              help="Number of instances of each selected type.")
 @click.option("-t", "--instance-type", type=click.Choice(["g4dn.4xlarge", "p3.2xlarge"]),
               default="g4dn.4xlarge", show_default=True, help="EC2 GPU instance type.")
 @click.option("--lifetime", default="24", show_default=True,
@@ -228,32 +386,50 @@ def wait(host, package, log_level):
 @click.option("--token", help="GitHub token (defaults to GITHUB_TOKEN environment variable).")
 @click.option("-l", "--log-level", type=click.Choice(["error", "warning", "info", "debug"], case_sensitive=False),
               default="info", show_default=True, help="Logging level.")
-def start_host(linux, windows, instance_type, lifetime, token, log_level):
+def start_host(linux, windows, count, instance_type, lifetime, token, log_level):
     """
-    Create a Linux or Windows GPU instance using rocket-platform.
+    Create Linux and/or Windows GPU instances using rocket-platform.
     """
+    from .util import create_gpu_instances
+
     setup_logging(log_level)
 
     if not linux and not windows:
-        raise click.UsageError("Either --linux or --windows must be specified")
-    if linux and windows:
-        raise click.UsageError("Only one of --linux or --windows can be specified")
-
-    create_gpu_instance(token, linux, instance_type, lifetime)
+        raise click.UsageError("At least one of --linux or --windows must be specified")
+
+    kinds = [True] * count * linux + [False] * count * windows
+    hosts = create_gpu_instances(token, kinds, instance_type, lifetime)
+    for h in hosts:
+        if h is not None:
+            print(h.host)
+    if None in hosts:
+        raise SystemExit(1)
 
 
 @cli.command(context_settings=HELP_CONTEXT)
-@click.argument("id_or_ip")
+@click.argument("ids_or_ips", nargs=-1)
+@click.option("-a", "--all", is_flag=True, help="Stop all the instances created from this machine.")
 @click.option("--token", help="GitHub token (defaults to GITHUB_TOKEN environment variable).")
 @click.option("-l", "--log-level", type=click.Choice(["error", "warning", "info", "debug"], case_sensitive=False),
               default="info", show_default=True, help="Logging level.")
-def stop_host(id_or_ip, token, log_level):
+def stop_host(ids_or_ips, all, token, log_level):
     """
-    Stop a GPU instance by ID or IP using rocket-platform.
+    Stop GPU instances by ID or IP using rocket-platform.
     """
+    from .util import stop_instances
+
     setup_logging(log_level)
 
-    stop_instance(token, id_or_ip)
+    if all:
+        # Only the hosts created by start-host have an instance ID, the others we don't know how to stop
+        ids_or_ips += tuple(h for h, info in registry.list_hosts().items() if info.get("instance_id"))
+        if not ids_or_ips:
+            logging.info("No known instances to stop")
+            return
+    if not ids_or_ips:
+        raise click.UsageError("Specify instance IDs or IPs, or --all")
+
+    stop_instances(token, list(dict.fromkeys(ids_or_ips)))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+import contextlib
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+
+
+# Upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf"))
+
+# The sisyphus command being run and the high-level step currently running, used to tag the operations. The command
+# is set once per process and must be seen by the worker threads too, which don't inherit context variables.
+_command = ""
+_step = contextvars.ContextVar("step", default="")
+
+
+class Operation:
+    """
+    Statistics for one type of remote operation within one step.
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.bytes_up = 0
+        self.bytes_down = 0
+
+
+    def add(self, seconds, bytes_up, bytes_down, error):
+        self.count += 1
+        self.errors += int(error)
+        self.seconds += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        self.bytes_up += bytes_up
+        self.bytes_down += bytes_down
+
+
+class Timer:
+    """
+    Time an operation, the byte counts can be set while it runs.
+    """
+    def __init__(self, op, bytes_up=0, bytes_down=0):
+        self.op = op
+        self.bytes_up = bytes_up
+        self.bytes_down = bytes_down
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc, tb):
+        registry.add(self.op, time.perf_counter() - self.start, self.bytes_up, self.bytes_down, exc_type is not None)
+
+
+class File:
+    """
+    Wrap a remote file to account for the bytes going through it, recorded as a single operation when it's closed.
+    """
+    def __init__(self, f, op):
+        self._f = f
+        self._timer = Timer(op).__enter__()
+
+
+    def __getattr__(self, name):
+        return getattr(self._f, name)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def read(self, *args):
+        data = self._f.read(*args)
+        self._timer.bytes_down += len(data)
+        return data
+
+
+    def write(self, data):
+        self._timer.bytes_up += len(data)
+        return self._f.write(data)
+
+
+    def close(self):
+        if self._timer is not None:
+            self._f.close()
+            self._timer.__exit__(None, None, None)
+            self._timer = None
+
+
+class Registry:
+    """
+    All the operations recorded by this process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+
+
+    def add(self, op, seconds, bytes_up=0, bytes_down=0, error=False):
+        """
+        Record an operation, tagged with the current command and step.
+        """
+        key = (_command, _step.get(), op)
+        with self.lock:
+            if key not in self.operations:
+                self.operations[key] = Operation()
+            self.operations[key].add(seconds, bytes_up, bytes_down, error)
+
+
+    def to_json(self):
+        """
+        Return the metrics as JSON.
+        """
+        operations = []
+        with self.lock:
+            for (command, step, op), o in sorted(self.operations.items()):
+                operations.append({
+                    "command": command,
+                    "step": step,
+                    "op": op,
+                    "count": o.count,
+                    "errors": o.errors,
+                    "seconds": o.seconds,
+                    "histogram": {str(bound): n for bound, n in zip(BUCKETS, o.buckets)},
+                    "bytes_up": o.bytes_up,
+                    "bytes_down": o.bytes_down,
+                })
+        return json.dumps({"operations": operations}, indent=2)
+
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format.
+        """
+        seconds = ["# HELP sisyphus_remote_operation_seconds Latency of the operations on remote hosts.",
+                   "# TYPE sisyphus_remote_operation_seconds histogram"]
+        errors = ["# HELP sisyphus_remote_operation_errors_total Failed operations on remote hosts.",
+                  "# TYPE sisyphus_remote_operation_errors_total counter"]
+        transferred = ["# HELP sisyphus_remote_bytes_total Bytes sent to and received from remote hosts.",
+                       "# TYPE sisyphus_remote_bytes_total counter"]
+        with self.lock:
+            for (command, step, op), o in sorted(self.operations.items()):
+                labels = f'command="{command}",step="{step}",op="{op}"'
+                cumulative = 0
+                for bound, n in zip(BUCKETS, o.buckets):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else str(bound)
+                    seconds.append(f'sisyphus_remote_operation_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+                seconds.append(f"sisyphus_remote_operation_seconds_sum{{{labels}}} {o.seconds}")
+                seconds.append(f"sisyphus_remote_operation_seconds_count{{{labels}}} {o.count}")
+                errors.append(f"sisyphus_remote_operation_errors_total{{{labels}}} {o.errors}")
+                transferred.append(f'sisyphus_remote_bytes_total{{{labels},direction="up"}} {o.bytes_up}')
+                transferred.append(f'sisyphus_remote_bytes_total{{{labels},direction="down"}} {o.bytes_down}')
+        return "\n".join(seconds + errors + transferred) + "\n"
+
+
+    def dump(self, path, format="json"):
+        """
+        Write the metrics to a file.
+        """
+        logging.debug("Writing metrics to '%s'", path)
+        with open(path, "w") as f:
+            f.write(self.to_prometheus() if format == "prometheus" else self.to_json())
+
+
+registry = Registry()
+
+
+def set_command(command):
+    """
+    Set the name of the sisyphus command being run.
+    """
+    global _command
+    _command = command
+
+
+def timer(op, bytes_up=0, bytes_down=0):
+    """
+    Time a remote operation.
+    """
+    return Timer(op, bytes_up, bytes_down)
+
+
+@contextlib.contextmanager
+def step(name):
+    """
+    Tag the operations run within this context with a high-level step name.
+    """
+    token = _step.set(name)
+    try:
+        yield
+    finally:
+        _step.reset(token)
+
+
+def tagged(func):
+    """
+    Decorator tagging the operations run by a method with its name, unless it's called from another tagged step.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _step.get():
+            return func(*args, **kwargs)
+        with step(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,187 @@
+import concurrent.futures
+import logging
+import re
+
+from .build import Build
+from .host import Host
+from .script import Script
+
+
+def parse_spec(path):
+    """
+    Read a pipeline spec file: one feedstock per line, optionally followed by a branch, '#' starts a comment.
+    """
+    specs = []
+    with open(path) as f:
+        for line in f:
+            fields = line.split("#", 1)[0].split()
+            if fields:
+                specs.append((fields[0], fields[1] if len(fields) > 1 else None))
+    return specs
+
+
+def parse_recipe(recipe):
+    """
+    Return the names of the packages a recipe produces and of all the packages it requires.
+    This is a best effort at reading the Jinja templated YAML without rendering it, good enough for ordering builds.
+    """
+    # Substitute the simple '{% set name = "value" %}' variables, which are commonly used for the package names
+    variables = dict(re.findall(r"""{%-?\s*set\s+(\w+)\s*=\s*["']([^"']*)["']\s*-?%}""", recipe))
+    recipe = re.sub(r"{{\s*(\w+)\s*(\|\s*lower\s*)?}}", lambda m: variables.get(m.group(1), m.group(0)), recipe)
+
+    outputs = set()
+    requirements = set()
+    block = None
+    for line in recipe.splitlines():
+        stripped = line.split("#", 1)[0].rstrip()
+        if not stripped.strip():
+            continue
+        indent = len(stripped) - len(stripped.lstrip(" -"))
+        # Leaving a requirements block
+        if block is not None and indent <= block:
+            block = None
+        m = re.match(r"^[\s-]*name:\s*['\"]?([A-Za-z0-9_.+-]+)", stripped)
+        if m and block is None:
+            outputs.add(m.group(1).lower())
+            continue
+        if re.match(r"^[\s-]*requirements:\s*$", stripped):
+            block = indent
+            continue
+        m = re.match(r"^\s*-\s*['\"]?([A-Za-z0-9_.+-]+)", stripped)
+        if m and block is not None:
+            requirements.add(m.group(1).lower())
+    return outputs, requirements
+
+
+class Stage:
+    """
+    A feedstock to build as part of a pipeline.
+    """
+    def __init__(self, package, branch):
+        self.package = package
+        self.build = Build(package, branch)
+        self.outputs = set()
+        self.requirements = set()
+        # Stages this one needs the packages of
+        self.upstream = set()
+
+
+    def channels(self):
+        """
+        All the stages whose packages are needed to build this one, directly or not.
+        """
+        stages = set()
+        for stage in self.upstream:
+            stages.add(stage)
+            stages |= stage.channels()
+        return stages
+
+
+class Pipeline:
+    """
+    Build several feedstocks on a host, ordered by their requirements, running independent branches in parallel.
+    The packages built by each stage are made available to the next ones as a local channel on the host.
+    """
+    def __init__(self, host, specs, jobs=2):
+        """
+        specs is a list of (package, branch) tuples, branch can be None to use the default one.
+        """
+        self.host = host
+        self.jobs = jobs
+        self.stages = [Stage(package, branch) for package, branch in specs]
+
+
+    def __resolve(self):
+        """
+        Figure out which stages depend on which from their recipes.
+        """
+        for stage in self.stages:
+            if stage.build.recipe is None:
+                logging.warning("No recipe found for '%s', assuming it doesn't depend on anything", stage.package)
+                continue
+            stage.outputs, stage.requirements = parse_recipe(stage.build.recipe)
+            logging.debug("'%s' produces %s", stage.package, ", ".join(sorted(stage.outputs)))
+        for stage in self.stages:
+            for other in self.stages:
+                if other is not stage and stage.requirements & other.outputs:
+                    stage.upstream.add(other)
+
+        # Make sure there's a possible order
+        done = set()
+        while len(done) < len(self.stages):
+            ready = [s for s in self.stages if s not in done and s.upstream <= done]
+            if not ready:
+                cycle = ", ".join(s.package for s in self.stages if s not in done)
+                logging.error("Circular dependencies between: %s", cycle)
+                raise SystemExit(1)
+            done.update(ready)
+
+        for stage in self.stages:
+            if stage.upstream:
+                logging.info("'%s' needs %s", stage.package, ", ".join(sorted(s.package for s in stage.upstream)))
+
+
+    def __build(self, stage):
+        """
+        Build a stage on its own connection to the host and wait for the result.
+        """
+        h = Host(self.host.host)
+        workdir = h.path(stage.package)
+        channels = [h.channel_url(h.path(s.package, "build")) for s in stage.channels()]
+        logging.info("Building '%s'", stage.package)
+        h.build(workdir, sorted(channels))
+        return h.wait(stage.package)
+
+
+    def run(self):
+        """
+        Upload the data for all the stages then build them in order.
+        """
+        h = self.host
+        h.prepare()
+
+        for stage in self.stages:
+            stage.build.upload_data(h)
+            s = Script(h)
+            s.rm(h.path(stage.package))
+            s.untar(h.path(stage.build.tarfile), h.path(stage.package))
+            s.rm(h.path(stage.build.tarfile))
+            s.execute()
+            logging.info("Data for '%s' ready on host", stage.package)
+        self.__resolve()
+
+        h.watch_prepare()
+
+        # Start the stages as soon as everything they need has been built
+        done = set()
+        failed = set()
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while True:
+                # Skipping a stage can cause others to be skipped too, so keep going until nothing changes
+                changed = True
+                while changed:
+                    changed = False
+                    for stage in self.stages:
+                        if stage in done or stage in failed or stage in running.values():
+                            continue
+                        if stage.upstream & failed:
+                            logging.error("Skipping '%s' because a package it needs failed to build", stage.package)
+                            failed.add(stage)
+                            changed = True
+                        elif stage.upstream <= done:
+                            running[executor.submit(self.__build, stage)] = stage
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    if future.exception() is None and future.result():
+                        logging.info("'%s' built successfully", stage.package)
+                        done.add(stage)
+                    else:
+                        logging.error("'%s' failed to build", stage.package)
+                        failed.add(stage)
+
+        if failed:
+            raise SystemExit(1)
@@ -0,0 +1,130 @@
+import logging
+import re
+
+from .script import MARKER
+
+
+# -Command - makes PowerShell read and run the commands from standard input one line at a time, as they come
+COMMAND = "powershell -NoLogo -NoProfile -NonInteractive -Command -"
+# Seconds to wait for PowerShell to start and answer the first request before giving up on it
+STARTUP_TIMEOUT = 30
+
+
+def quote(s):
+    """
+    Quote a string for PowerShell, where nothing is special inside single quotes except single quotes themselves.
+    """
+    return "'" + s.replace("'", "''") + "'"
+
+
+def exists_script(path):
+    return f"if (Test-Path -LiteralPath {quote(path)}) {{ 'Yes' }} else {{ 'No' }}"
+
+
+def isdir_script(path):
+    return f"if (Test-Path -LiteralPath {quote(path)} -PathType Container) {{ 'Yes' }} else {{ 'No' }}"
+
+
+def ls_script(path):
+    return f"Get-ChildItem -LiteralPath {quote(path)} -Name"
+
+
+def mkdir_script(path):
+    return (f"if (Test-Path -LiteralPath {quote(path)} -PathType Leaf) "
+            f"{{ throw ({quote(path)} + ' already exists and is a file, can''t create directory') }}; "
+            f"New-Item -ItemType Directory -Force -Path {quote(path)} | Out-Null")
+
+
+def rm_script(path):
+    return f"if (Test-Path -LiteralPath {quote(path)}) {{ Remove-Item -LiteralPath {quote(path)} -Recurse -Force }}"
+
+
+def follow_script(logfile, skip, ready, failed, max_lines):
+    """
+    Print whether the ready and failed files exist on the first line, then at most max_lines new complete lines of the
+    log. The log stays open in the session between calls so that reading it again only reads what was added, it's opened
+    skipping the lines already read the first time. Lines over the limit are kept for the next call, and the build is
+    only reported as over once they have all been printed, at which point the log is closed.
+    """
+    f = quote(logfile)
+    return "; ".join([
+        "if (-not $global:readers) { $global:readers = @{} }",
+        # Checking first so that we don't miss the last lines
+        f"$ready = Test-Path -LiteralPath {quote(ready)}",
+        f"$failed = Test-Path -LiteralPath {quote(failed)}",
+        "$lines = @()",
+        f"if (-not $global:readers.ContainsKey({f}) -and (Test-Path -LiteralPath {f})) {{ "
+        f"$r = [IO.StreamReader]::new([IO.FileStream]::new({f}, 'Open', 'Read', 'ReadWrite')); "
+        f"for ($i = 0; $i -lt {skip} -and $r.ReadLine() -ne $null; $i++) {{}}; "
+        f"$global:readers[{f}] = @{{ Reader = $r; Rest = '' }} }}",
+        f"if ($global:readers.ContainsKey({f})) {{ "
+        f"$s = $global:readers[{f}]; "
+        "$buffer = [char[]]::new(65536); "
+        # Don't read more than needed for this call
+        f"while (($s.Rest.Split(\"`n\").Count - 1) -lt {max_lines} -and ($n = $s.Reader.Read($buffer, 0, $buffer.Length)) -gt 0) "
+        "{ $s.Rest += [string]::new($buffer, 0, $n) }; "
+        "$all = $s.Rest -split \"`r?`n\"; "
+        # The last line may still be being written, keep it for next time unless the build is over
+        f"$count = [Math]::Min($all.Count - 1, {max_lines}); "
+        "if ($count -gt 0) { $lines = @($all[0..($count - 1)]) }; "
+        "$s.Rest = $all[$count..($all.Count - 1)] -join \"`n\"; "
+        "if ($s.Rest.Contains(\"`n\")) { $ready = $false; $failed = $false } "
+        "elseif (($ready -or $failed) -and $s.Rest) { $lines += $s.Rest; $s.Rest = '' }; "
+        # Everything has been read, close the log so that it can be deleted
+        f"if ($ready -or $failed) {{ $s.Reader.Dispose(); $global:readers.Remove({f}) }} }}",
+        "\"$ready $failed\"",
+        "$lines",
+    ])
+
+
+class PowerShell:
+    """
+    PowerShell process kept running on a Windows host and driven over a single SSH channel, so that running simple
+    operations doesn't pay for starting a new process, which takes about a second for PowerShell.
+
+    Each request is a single line of PowerShell, its output is framed by marker lines which also carry whether it
+    succeeded.
+    """
+    def __init__(self, connection):
+        self.channel = connection.client.get_transport().open_session()
+        self.channel.exec_command(COMMAND)
+        self.requests = 0
+        self.buffer = b""
+        # Also checks that it works at all
+        self.run("[Console]::OutputEncoding = [Text.UTF8Encoding]::new($false)", STARTUP_TIMEOUT)
+
+
+    def run(self, script, timeout=None):
+        """
+        Run a line of PowerShell, return whether it succeeded and its output.
+        Raise an exception if the session is broken.
+        """
+        self.requests += 1
+        n = self.requests
+        line = (f"Write-Output '{MARKER}-begin {n}'; $ok = 1; "
+                f"try {{ $ErrorActionPreference = 'Stop'; {script} }} catch {{ Write-Output $_.ToString(); $ok = 0 }}; "
+                f"Write-Output \"{MARKER}-end {n} $ok\"")
+        # The empty line terminates the statement in case PowerShell thinks it's incomplete
+        self.channel.settimeout(timeout)
+        self.channel.sendall((line + "\n\n").encode())
+
+        end = re.compile(rb"^" + re.escape(f"{MARKER}-end {n} ".encode()) + rb"([01])\r?$", re.MULTILINE)
+        while (m := end.search(self.buffer)) is None:
+            data = self.channel.recv(65536)
+            if not data:
+                raise EOFError(f"PowerShell exited with status {self.channel.recv_exit_status()}")
+            self.buffer += data
+        output = self.buffer[:m.start()]
+        self.buffer = self.buffer[m.end():].lstrip(b"\r\n")
+
+        # Anything before the begin marker isn't ours, like PowerShell echoing the input
+        begin = re.search(rb"^" + re.escape(f"{MARKER}-begin {n}".encode()) + rb"\r?\n", output, re.MULTILINE)
+        if begin is None:
+            raise EOFError("PowerShell output isn't framed as expected")
+        output = output[begin.end():].decode(errors="replace").replace("\r\n", "\n")
+        return m.group(1) == b"1", output
+
+
+    def close(self):
+        logging.debug("Closing the PowerShell session")
+        self.channel.close()
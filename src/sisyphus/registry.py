@@ -0,0 +1,92 @@
+import contextlib
+import json
+import logging
+import os
+import tempfile
+
+# File locking is done differently on Windows
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+def home():
+    """
+    Directory where Sisyphus keeps its local state, can be overridden with the SISYPHUS_HOME environment variable.
+    """
+    path = os.environ.get("SISYPHUS_HOME", os.path.join(os.path.expanduser("~"), ".sisyphus"))
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def lock(f):
+    """
+    Lock an open file exclusively, waiting until it's available. The lock goes away when the file is closed.
+    """
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return
+    # msvcrt only retries for 10 seconds before giving up, keep trying
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass
+
+
+def write_json(path, data):
+    """
+    Write a JSON file atomically so that it's never left half-written.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, path)
+
+
+@contextlib.contextmanager
+def hosts():
+    """
+    Access the registry of known hosts for reading and writing, locked so that concurrent commands don't lose updates.
+
+    Usage:
+        with registry.hosts() as h:
+            h["1.2.3.4"] = {"type": "linux"}
+    """
+    path = os.path.join(home(), "hosts.json")
+    with open(path + ".lock", "w") as lockfile:
+        lock(lockfile)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except json.JSONDecodeError:
+            logging.warning("Host registry '%s' is corrupted, starting over", path)
+            data = {}
+        before = json.dumps(data, sort_keys=True)
+        yield data
+        if json.dumps(data, sort_keys=True) != before:
+            write_json(path, data)
+
+
+def add_host(host, type=None, **info):
+    """
+    Record a host, along with its type and any other information.
+    """
+    with hosts() as h:
+        entry = h.setdefault(host, {})
+        if type:
+            entry["type"] = type
+        entry.update(info)
+
+
+def list_hosts():
+    """
+    Return the known hosts and their information.
+    """
+    with hosts() as h:
+        return dict(h)
@@ -0,0 +1,138 @@
+import logging
+import re
+
+
+# Prefix of the lines marking the end of each step in the output of a script
+MARKER = "@@sisyphus"
+
+
+class Step:
+    """
+    A step of a remote script and, once it has run, its result.
+    """
+    def __init__(self, name, cmd, parse=None):
+        self.name = name
+        self.cmd = cmd
+        self.parse = parse
+        # These stay None if the step didn't run because a previous one failed
+        self.exit_code = None
+        self.output = None
+        self.value = None
+
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+
+class Script:
+    """
+    Compose a sequence of Host operations into a single remote script, run in one round-trip.
+
+    Usage:
+        s = Script(host)
+        s.rm(workdir)
+        s.untar(tarfile, workdir)
+        ready = s.exists(readyfile)
+        s.execute()
+        if ready.value:
+            ...
+    """
+    def __init__(self, host, stop_on_error=True):
+        """
+        Stop at the first failing step unless stop_on_error is False.
+        """
+        self.host = host
+        self.stop_on_error = stop_on_error
+        self.steps = []
+
+
+    def run(self, cmd, name="run", parse=None, stderr=None):
+        """
+        Add a raw command, parse is an optional function converting its output to the step value.
+        The errors of the command are part of its output if stderr is True, by default only if the output isn't parsed.
+        """
+        if stderr is None:
+            stderr = parse is None
+        if not stderr:
+            cmd = f"( {cmd} ) 2>{self.host.devnull}"
+        step = Step(name, cmd, parse)
+        self.steps.append(step)
+        return step
+
+
+    def exists(self, path):
+        """
+        Check if a remote file or directory exists.
+        """
+        return self.run(self.host.exists_cmd(path), "exists", lambda out: out == "Yes")
+
+
+    def isdir(self, path):
+        """
+        Check if a remote path is a directory.
+        """
+        return self.run(self.host.isdir_cmd(path), "isdir", lambda out: out == "Yes")
+
+
+    def mkdir(self, path):
+        """
+        Create a remote directory if it doesn't exist.
+        """
+        return self.run(self.host.mkdir_if_missing_cmd(path), "mkdir")
+
+
+    def ls(self, path):
+        """
+        List the contents of a remote directory.
+        """
+        return self.run(self.host.ls_cmd(path), "ls", lambda out: out.splitlines())
+
+
+    def rm(self, path):
+        """
+        Delete a remote file or directory if it exists.
+        """
+        return self.run(self.host.rm_if_exists_cmd(path), "rm")
+
+
+    def untar(self, filepath, dest):
+        """
+        Untar a remote file into a remote directory, creating the latter if needed.
+        """
+        self.mkdir(dest)
+        return self.run(self.host.untar_cmd(filepath, dest), "untar")
+
+
+    def execute(self, check=True, retry=False):
+        """
+        Run the script and fill in the results of the steps, exit on error if check is True.
+        Only pass retry=True for scripts that don't change anything on the host, see Host.run().
+        """
+        # The output is kept as is, so that blank lines and indentation in the output of the steps are preserved
+        output = self.host.run(self.host.script_cmd([s.cmd for s in self.steps], self.stop_on_error), retry=retry,
+                               strip=False)
+        # cmd's echo keeps the spaces before & at the end of the lines
+        marker = re.compile(f"^{MARKER} (\\d+) (-?\\d+)[ \\t]*\\r?$", re.MULTILINE)
+        start = 0
+        for m in marker.finditer(output):
+            # Drop the end of line of the previous marker and the one added before this marker
+            text = output[start:m.start()]
+            if start > 0:
+                text = re.sub(r"\A\r?\n", "", text)
+            text = re.sub(r"[ \t]*\r?\n\Z", "", text)
+            start = m.end()
+            step = self.steps[int(m.group(1))]
+            step.exit_code = int(m.group(2))
+            step.output = text
+            if step.ok and step.parse:
+                step.value = step.parse(text.strip())
+
+        for step in self.steps:
+            if step.exit_code is not None and not step.ok:
+                logging.error("'%s' failed with exit code %d", step.cmd, step.exit_code)
+                for line in step.output.splitlines():
+                    logging.error(line)
+                if check:
+                    raise SystemExit(1)
+        return self.steps
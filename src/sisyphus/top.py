@@ -0,0 +1,135 @@
+import click
+import concurrent.futures
+import logging
+import shutil
+import time
+
+from .host import Host
+
+
+def human_size(size):
+    """
+    Format a number of bytes for humans.
+    """
+    for unit in ("B", "K", "M", "G"):
+        if size < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def human_time(seconds):
+    """
+    Format a duration for humans.
+    """
+    if seconds is None:
+        return "-"
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}:{rest // 60:02d}:{rest % 60:02d}"
+
+
+class Dashboard:
+    """
+    Live view of the builds on several hosts, polled concurrently. A slow host doesn't hold up the others, it keeps
+    showing what it last reported until it answers.
+    """
+    def __init__(self, hosts, jobs=8):
+        self.hosts = hosts
+        self.jobs = jobs
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        # Connections are kept from one refresh to the next so we don't pay for Host initialization every time
+        self.connections = {}
+        # Polls that didn't finish by the end of their refresh, they're waited for again instead of piling up
+        self.pending = {}
+        # Rows last shown for each host
+        self.rows = {}
+        # Log size and time of the previous refresh for each build, to compute how fast the logs grow
+        self.previous = {}
+
+
+    def __poll(self, host):
+        """
+        Get the state of all the builds on a host in a single round-trip.
+        """
+        try:
+            if host not in self.connections:
+                self.connections[host] = Host(host)
+            return self.connections[host].builds()
+        except (Exception, SystemExit) as e:
+            # Reconnect on the next refresh
+            self.connections.pop(host, None)
+            logging.debug("Polling '%s' failed: %s", host, e)
+            return None
+
+
+    def poll(self, timeout=None):
+        """
+        Poll all the hosts, return rows for display. Hosts that haven't answered within timeout seconds show their
+        previous rows, or as unreachable if they never answered.
+        """
+        for host in self.hosts:
+            if host not in self.pending:
+                self.pending[host] = self.executor.submit(self.__poll, host)
+        concurrent.futures.wait(self.pending.values(), timeout)
+
+        now = time.monotonic()
+        rows = []
+        for host in self.hosts:
+            if not self.pending[host].done():
+                logging.debug("'%s' is late, showing its previous status", host)
+                rows += self.rows.get(host, [(host, "-", "Unreachable", "-", "-", "-", "")])
+                continue
+            builds = self.pending.pop(host).result()
+            if builds is None:
+                self.rows[host] = [(host, "-", "Unreachable", "-", "-", "-", "")]
+            elif not builds:
+                self.rows[host] = [(host, "-", "Idle", "-", "-", "-", "")]
+            else:
+                self.rows[host] = []
+            for package, b in sorted((builds or {}).items()):
+                rate = "-"
+                if (host, package) in self.previous:
+                    size, then = self.previous[(host, package)]
+                    rate = human_size(max(b["log_size"] - size, 0) / (now - then)) + "/s"
+                self.previous[(host, package)] = (b["log_size"], now)
+                self.rows[host].append((host, package, b["status"], human_time(b["elapsed"]), rate, human_size(b["du"]),
+                                        b["last"]))
+            rows += self.rows[host]
+        return rows
+
+
+    def render(self, rows):
+        """
+        Format the rows as a table fitting the terminal width.
+        """
+        header = ("HOST", "PACKAGE", "STATUS", "ELAPSED", "LOG RATE", "DISK", "LAST LOG LINE")
+        widths = [max(len(r[i]) for r in rows + [header]) for i in range(len(header) - 1)]
+        width = shutil.get_terminal_size().columns
+        lines = []
+        for row in [header] + rows:
+            line = "  ".join(f"{c:<{w}}" for c, w in zip(row, widths)) + "  " + row[-1]
+            lines.append(line[:width])
+        return "\n".join(lines)
+
+
+    def run(self, interval=5, once=False):
+        """
+        Refresh the view in place until interrupted, or print it once.
+        """
+        try:
+            while True:
+                start = time.monotonic()
+                # Late hosts don't delay the refresh, they catch up on the next one
+                table = self.render(self.poll(interval))
+                if once:
+                    print(table)
+                    return
+                click.clear()
+                print(time.strftime("%H:%M:%S"), f"- {len(self.hosts)} host(s), refreshing every {interval}s")
+                print(table)
+                time.sleep(max(interval - (time.monotonic() - start), 0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Don't wait for the hosts that still haven't answered
+            self.executor.shutdown(wait=False, cancel_futures=True)
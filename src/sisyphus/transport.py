@@ -0,0 +1,162 @@
+import logging
+import socket
+import threading
+import time
+
+
+# paramiko's default, enough for a fast LAN but it caps the throughput at window / RTT on long links
+DEFAULT_WINDOW_SIZE = 2 * 1024 * 1024
+MAX_WINDOW_SIZE = 64 * 1024 * 1024
+# Throughput assumed until a transfer tells us better, to size the windows from the RTT alone
+ASSUMED_THROUGHPUT = 50 * 1024 * 1024
+# A session is considered dead when it doesn't answer within this many RTTs, but never less than MIN_TIMEOUT seconds
+TIMEOUT_RTTS = 20
+MIN_TIMEOUT = 5
+MAX_TIMEOUT = 30
+PINGS = 2
+
+
+class Link:
+    """
+    Health of the SSH transport of a fabric connection: measures the round-trip time and the throughput, tunes the
+    keepalives and windows to match, and tells whether the session is still alive.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rtt = None
+        self.throughput = None
+
+
+    @property
+    def transport(self):
+        return self.connection.client.get_transport()
+
+
+    @property
+    def timeout(self):
+        """
+        How long to wait for an answer before declaring the session dead.
+        """
+        if self.rtt is None:
+            return MAX_TIMEOUT
+        return min(max(self.rtt * TIMEOUT_RTTS, MIN_TIMEOUT), MAX_TIMEOUT)
+
+
+    def ping(self):
+        """
+        Time a round-trip at the SSH protocol level, without running anything on the host.
+        Return None if there's no answer before the timeout.
+        """
+        transport = self.transport
+        if transport is None or not transport.is_active():
+            return None
+        # The request blocks until there's an answer or the transport dies, so wait for it in a thread
+        answered = []
+        def request():
+            try:
+                transport.global_request("keepalive@openssh.com")
+            except Exception as e:
+                logging.debug("Ping failed: %s", e)
+            else:
+                answered.append(time.perf_counter())
+        start = time.perf_counter()
+        thread = threading.Thread(target=request, daemon=True)
+        thread.start()
+        thread.join(self.timeout)
+        if not answered or not transport.is_active():
+            return None
+        return answered[0] - start
+
+
+    def alive(self):
+        """
+        Check whether the session still works.
+        """
+        return self.ping() is not None
+
+
+    def tune(self):
+        """
+        Measure the link and set the keepalives and windows accordingly.
+        """
+        samples = [rtt for rtt in (self.ping() for _ in range(PINGS)) if rtt is not None]
+        if not samples:
+            logging.debug("Couldn't measure the round-trip time")
+            return
+        # Anything above the minimum is noise from the host or the network being busy
+        self.rtt = min(samples)
+        transport = self.transport
+
+        # Send keepalives often enough that a dead session is noticed by the timeout below even when idle
+        interval = max(int(self.timeout / 2), 1)
+        transport.set_keepalive(interval)
+        sock = getattr(transport, "sock", None)
+        if isinstance(sock, socket.socket):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # These are Linux specific, other platforms keep the system defaults
+            for option, value in (("TCP_KEEPIDLE", interval), ("TCP_KEEPINTVL", interval), ("TCP_KEEPCNT", 3),
+                                  ("TCP_USER_TIMEOUT", int(self.timeout * 1000))):
+                if hasattr(socket, option):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+        self.__size_windows()
+        logging.debug("Round-trip time %.1fms, keepalive every %ds, window %dKiB", self.rtt * 1000, interval,
+                      transport.default_window_size // 1024)
+
+
+    def __size_windows(self):
+        """
+        Make the windows of the new channels large enough to not limit the throughput, twice the bandwidth-delay product.
+        """
+        bdp = (self.throughput or ASSUMED_THROUGHPUT) * self.rtt
+        self.transport.default_window_size = int(min(max(2 * bdp, DEFAULT_WINDOW_SIZE), MAX_WINDOW_SIZE))
+
+
+    def record(self, size, seconds):
+        """
+        Account for a transfer to estimate the throughput, and resize the windows if it's worth it.
+        """
+        # Small transfers are dominated by the latency and say nothing about the throughput
+        if self.rtt is None or seconds <= 0 or size < 1024 * 1024:
+            return
+        throughput = size / seconds
+        self.throughput = throughput if self.throughput is None else (self.throughput + throughput) / 2
+        self.__size_windows()
+        logging.debug("Throughput %.1fMiB/s", self.throughput / 1024 / 1024)
+
+
+class ResumableFile:
+    """
+    Remote file opened for reading that transparently reopens itself where it was if the connection dies.
+    """
+    def __init__(self, host, path):
+        self.host = host
+        self.path = path
+        self.position = 0
+        self.f = None
+        self.__open()
+
+
+    def __open(self):
+        self.f = self.host.connection.sftp().open(self.path, "rb")
+        self.f.seek(self.position)
+        # Don't wait for the server to answer every single read
+        self.f.prefetch()
+
+
+    def read(self, size=-1):
+        try:
+            data = self.f.read(size)
+        except Exception:
+            if self.host.link.alive():
+                raise
+            logging.warning("Connection lost while reading '%s', resuming at %d bytes", self.path, self.position)
+            self.host.reconnect()
+            self.__open()
+            data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+
+    def close(self):
+        self.f.close()
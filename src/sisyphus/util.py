@@ -1,20 +1,22 @@
+import concurrent.futures
 import json
 import logging
+import shutil
 import urllib.request
 import urllib.error
 
+from . import registry
 from .host import Host
-from pushbutan.src.pushbutan.pushbutan import Pushbutan
 
 
-def download(url, path):
+def stream(url, f):
     """
-    Download a file and save it.
+    Download a file and write it to a file object as it comes in.
     """
     logging.debug("Downloading '%s'", url)
     try:
-        with urllib.request.urlopen(url) as response, open(path, 'wb') as out_file:
-            out_file.write(response.read())
+        with urllib.request.urlopen(url) as response:
+            shutil.copyfileobj(response, f)
     except urllib.error.HTTPError as e:
         logging.error("HTTP Error: %s - %s", e.code, e.reason)
         raise SystemExit(1)
@@ -40,79 +42,119 @@ def query_api(url):
         raise SystemExit(1)
 
 
-def create_gpu_instance(token, linux, instance_type, lifetime):
+def create_gpu_instances(token, kinds, instance_type, lifetime):
     """
-    Create a GPU instance using rocket-platform.
+    Create several GPU instances using rocket-platform, triggering all the workflows first then waiting for all the
+    instances at once.
 
     Args:
         token: str, GitHub token for authentication
-        linux: bool, True for Linux instance, False for Windows
+        kinds: list of bool, True for a Linux instance, False for a Windows one
         instance_type: str, EC2 instance type
         lifetime: str, hours before instance termination
 
     Returns:
-        str: IP address of the created instance
+        list of Host: the created instances in the same order as kinds, None for the ones that failed
 
     Raises:
-        SystemExit: If instance creation fails
+        SystemExit: If no instance could be requested at all
     """
+    # The rocket-platform client is slow to import and only needed here and in stop_instances()
+    from pushbutan.src.pushbutan.pushbutan import Pushbutan
+
+    runs = []
     try:
         pb = Pushbutan(token)
-        if linux:
-            logging.info(f"Creating Linux GPU instance ({instance_type})...")
-            result = pb.trigger_linux_gpu_instance(
-                instance_type=instance_type,
-                lifetime=lifetime
-            )
-        else:
-            logging.info(f"Creating Windows GPU instance ({instance_type})...")
-            result = pb.trigger_windows_gpu_instance(
-                instance_type=instance_type,
-                lifetime=lifetime
-            )
-
-        instance = pb.wait_for_instance(result["run_id"])
-        ip = instance['ip_address']
-        id = instance['instance_id']
-        h = Host(ip)
-        h.run(f"echo {id} > {h.path('instance_id')}")
-        logging.info(f"Instance ready at: {ip} (ID: {id})")
-        return h
-
+        for linux in kinds:
+            if linux:
+                logging.info(f"Creating Linux GPU instance ({instance_type})...")
+                result = pb.trigger_linux_gpu_instance(
+                    instance_type=instance_type,
+                    lifetime=lifetime
+                )
+            else:
+                logging.info(f"Creating Windows GPU instance ({instance_type})...")
+                result = pb.trigger_windows_gpu_instance(
+                    instance_type=instance_type,
+                    lifetime=lifetime
+                )
+            runs.append(result["run_id"])
     except Exception as e:
         logging.error(f"Failed to create instance: {e}")
-        raise SystemExit(1)
-
-
-def stop_instance(token, id):
+        if not runs:
+            raise SystemExit(1)
+        logging.warning("Waiting for the %d instance(s) already requested anyway", len(runs))
+
+    def wait(run_id):
+        try:
+            # One client per thread, we don't know whether they can be shared
+            instance = Pushbutan(token).wait_for_instance(run_id)
+            ip = instance['ip_address']
+            id = instance['instance_id']
+            h = Host(ip)
+            h.run(f"echo {id} > {h.path('instance_id')}")
+            registry.add_host(ip, h.type, instance_id=id)
+            logging.info(f"Instance ready at: {ip} (ID: {id})")
+            return h
+        except (Exception, SystemExit) as e:
+            logging.error(f"Failed to create instance: {e}")
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(runs)) as executor:
+        hosts = list(executor.map(wait, runs))
+    return hosts + [None] * (len(kinds) - len(hosts))
+
+
+def instance_id(identifier, known):
+    """
+    Return the instance ID of a host given either its ID or its IP address.
+    IP addresses are looked up in the registry, and only if that fails in the instance_id file on the host itself.
     """
-    Stop a GPU instance using rocket-platform.
+    # Simple check for IP address format
+    if '.' not in identifier:
+        return identifier
+    id = known.get(identifier, {}).get("instance_id")
+    if id:
+        return id
+    logging.debug("'%s' isn't in the registry, asking the host for its ID", identifier)
+    h = Host(identifier)
+    return h.run(f"{h.cat} {h.path('instance_id')}").strip()
+
+
+def stop_instances(token, identifiers):
+    """
+    Stop several GPU instances at once using rocket-platform.
 
     Args:
         token: str, GitHub token for authentication
-        instance_identifier: str, either IP address or instance ID
+        identifiers: list of str, either IP addresses or instance IDs
 
     Raises:
-        SystemExit: If instance termination fails
+        SystemExit: If any instance termination fails, after trying to stop the others
     """
-    try:
-        pb = Pushbutan(token)
-
-        # If the identifier looks like an IP address, we need to get the ID first
-        if '.' in id:  # Simple check for IP address format
-            # Read the instance ID from the remote file
-            h = Host(id)
-            try:
-                id = h.run(f"{h.cat} {h.path('instance_id')}").strip()
-                logging.info(f"Instance ID: {id}")
-            except Exception as e:
-                logging.error(f"Failed to get instance ID from IP {id}: {e}")
-                raise SystemExit(1)
-
-        logging.info(f"Stopping instance {id}...")
-        pb.stop_instance(id)
-        logging.info("Instance stopped successfully")
-
-    except Exception as e:
-        logging.error(f"Failed to stop instance: {e}")
-        raise SystemExit(1)
\ No newline at end of file
+    from pushbutan.src.pushbutan.pushbutan import Pushbutan
+
+    known = registry.list_hosts()
+
+    def stop(identifier):
+        try:
+            id = instance_id(identifier, known)
+            logging.info(f"Stopping instance {id}...")
+            Pushbutan(token).stop_instance(id)
+            logging.info(f"Instance {id} stopped successfully")
+            return id
+        except (Exception, SystemExit) as e:
+            logging.error(f"Failed to stop instance {identifier}: {e}")
+            return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(identifiers)) as executor:
+        stopped = dict(zip(identifiers, executor.map(stop, identifiers)))
+
+    with registry.hosts() as hosts:
+        for identifier, id in stopped.items():
+            if id is None:
+                continue
+            for host in [h for h, info in hosts.items() if h == identifier or info.get("instance_id") == id]:
+                del hosts[host]
+    if None in stopped.values():
+        raise SystemExit(1)